@@ -1,18 +1,31 @@
+import time
+SCRIPT_STARTED = time.perf_counter()
+
 import streamlit as st
 import sqlite3
 import hashlib
 import threading
-import pygame
-from yfinance import Ticker
 import pandas as pd
-import plotly.express as px
-import requests
-from newsapi import NewsApiClient
+import numpy as np
 import os
 from pathlib import Path
 import base64
-from datetime import datetime
-import time
+import functools
+import re
+import json
+import zlib
+from datetime import datetime, timezone
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+from singletons import process_resource
+
+# pygame, yfinance, plotly, requests and newsapi are imported inside the
+# functions that use them, so a replica only pays for a module once the
+# feature that needs it is first used
+IMPORT_SECONDS = time.perf_counter() - SCRIPT_STARTED
 
 # Constants
 INITIAL_BALANCE = 10000
@@ -31,29 +44,434 @@ TIME_RANGES = {
     'Max': 'max'
 }
 CURRENCIES = ["USD", "EUR", "GBP", "JPY", "AUD"]
+PAGES = ["Dashboard", "History", "Leaderboard"]
+TRANSACTION_PAGE_SIZE = 25
+
+# Charts are downsampled to about one min/max pair per pixel column
+CHART_WIDTH_PX = 1200
+
+# Database settings
+DATABASE_PATH = os.environ.get('CHARGING_BULL_DATABASE', 'trading_game.db')
+DB_POOL_SIZE = 8
+DB_POOL_WAIT = 1
+DB_BUSY_TIMEOUT = 30
+SQLITE_PRAGMAS = [
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT * 1000}"
+]
+
+# Order engine settings: the most orders committed in one transaction and
+# how long a session waits for its order to be executed
+ORDER_BATCH_SIZE = 64
+ORDER_TIMEOUT = 30
+
+# Quote cache settings: seconds each period's history stays fresh, and the
+# maximum number of (ticker, period) entries kept in memory
+QUOTE_CACHE_SIZE = 512
+QUOTE_CACHE_TTL = {
+    '1d': 30,
+    '5d': 300,
+    '1mo': 900,
+    '3mo': 1800,
+    '6mo': 3600,
+    '1y': 3600,
+    '5y': 6 * 3600,
+    '10y': 6 * 3600,
+    'max': 12 * 3600
+}
+DEFAULT_QUOTE_TTL = 60
+
+# Periods served from the local daily-bar history store, with how far back
+# each one reaches (None means the full history)
+HISTORY_PERIODS = {
+    '1mo': pd.DateOffset(months=1),
+    '3mo': pd.DateOffset(months=3),
+    '6mo': pd.DateOffset(months=6),
+    '1y': pd.DateOffset(years=1),
+    '5y': pd.DateOffset(years=5),
+    '10y': pd.DateOffset(years=10),
+    'max': None
+}
+
+# Per-user portfolio state cache: the most players kept in memory, and how
+# often a cached state re-checks its version against the database
+PORTFOLIO_CACHE_SIZE = 10000
+PORTFOLIO_REVALIDATE_SECONDS = 30
+
+# How long a caller waits on an identical upstream request already in flight
+SINGLE_FLIGHT_TIMEOUT = 30
+
+# Where quotes, exchange rates and news come from: 'live' calls yfinance,
+# exchangerate-api and NewsAPI, 'replay' serves the fixtures recorded in
+# FIXTURES_DIR and a seeded random walk for anything not recorded
+DATA_PROVIDER = os.environ.get('CHARGING_BULL_DATA_PROVIDER', 'live')
+FIXTURES_DIR = os.environ.get('CHARGING_BULL_FIXTURES', 'fixtures')
+SYNTHETIC_HISTORY_START = '2000-01-03'
+SYNTHETIC_USD_RATES = {'USD': 1.0, 'EUR': 0.92, 'GBP': 0.79, 'JPY': 150.0, 'AUD': 1.52}
+
+# Exchange-rate table settings
+FX_API_URL = 'https://api.exchangerate-api.com/v4/latest/{base}'
+FX_RATES_TTL = 3600
+FX_REQUEST_TIMEOUT = 10
+
+# Background market refresher settings
+GOLD_TICKER = 'GC=F'
+SNAPSHOT_MAX_AGE = 3 * UPDATE_INTERVAL
+
+# Valuation snapshots: how often every player is logged to financial_logs,
+# how long raw and hourly rows are kept once rolled up, and the smallest
+# batch each compaction pass deletes in
+VALUATION_INTERVAL = 5 * 60
+RAW_LOG_RETENTION_HOURS = 48
+HOURLY_LOG_RETENTION_DAYS = 30
+COMPACTION_BATCH_SIZE = 5000
+
+# NewsAPI key used when none is entered in the news panel
+NEWS_API_KEY = os.environ.get('NEWSAPI_KEY', 'your_newsapi_key_here')
+
+# News cache: seconds articles and errors stay cached, cache size, fetch
+# worker threads, and how often the news panel checks on a fetch in flight
+NEWS_CACHE_TTL = 15 * 60
+NEWS_ERROR_TTL = 60
+NEWS_CACHE_SIZE = 256
+NEWS_WORKERS = 4
+NEWS_POLL_INTERVAL = 3
+
+# Metrics: histogram bucket bounds in seconds, where and how often the
+# Prometheus text file is written, and the players allowed to see the
+# Diagnostics page (comma-separated usernames)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_FILE = os.environ.get('CHARGING_BULL_METRICS_FILE', 'metrics.prom')
+METRICS_EXPORT_INTERVAL = 15
+METRIC_HELP = {
+    'charging_bull_call_seconds': 'Latency of instrumented calls and upstream requests.',
+    'charging_bull_call_errors_total': 'Instrumented calls that raised an exception.',
+    'charging_bull_query_seconds': 'Latency of SQLite statements.',
+    'charging_bull_query_errors_total': 'SQLite statements that raised an exception.',
+    'charging_bull_panel_seconds': 'Time to render a page panel, or a whole rerun.',
+    'charging_bull_panel_errors_total': 'Panel renders that raised an exception.',
+    'charging_bull_cache_hits': 'Cache lookups served from memory.',
+    'charging_bull_cache_misses': 'Cache lookups that had to fetch.',
+    'charging_bull_cache_hit_ratio': 'Share of cache lookups served from memory.',
+    'charging_bull_startup_seconds': 'Cold-start timings of the server process.'
+}
+ADMIN_USERS = {name.strip() for name in os.environ.get('CHARGING_BULL_ADMINS', '').split(',') if name.strip()}
+
+# Background music is off by default, so servers never load pygame; set
+# CHARGING_BULL_MUSIC=1 to play it on a machine with speakers
+MUSIC_FILE = 'trade.mp3'
+ENABLE_MUSIC = os.environ.get('CHARGING_BULL_MUSIC', '0') == '1'
 
-# Initialize NewsAPI Client
-NEWS_API_KEY = 'your_newsapi_key_here'
-newsapi = NewsApiClient(api_key=NEWS_API_KEY)
+# Starts the music once per process; returns an error message, or '' when
+# the music is playing or disabled
+@process_resource
+def start_music():
+    if not ENABLE_MUSIC:
+        return ''
+    try:
+        os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+        import pygame
+    except ImportError as e:
+        print(f"Music disabled: {str(e)}")
+        return ''
+    try:
+        pygame.mixer.init()
+    except pygame.error as e:
+        # No audio device, as on a headless server
+        print(f"Music disabled: {str(e)}")
+        return ''
+    try:
+        pygame.mixer.music.load(MUSIC_FILE)
+        pygame.mixer.music.play(-1)
+        return ''
+    except Exception as e:
+        return f"Failed to load or play the music: {str(e)}. Please check that '{MUSIC_FILE}' exists in the correct directory."
 
 # Initialize pygame for music
 def initialize_music():
     if 'music_initialized' not in st.session_state:
+        error = start_music()
+        if error:
+            st.error(error)
+        st.session_state['music_initialized'] = True
+
+# Cold-start timings, recorded once per process
+@process_resource
+def get_startup_timings():
+    return {}
+
+def record_startup_timing(name, seconds):
+    timings = get_startup_timings()
+    if name not in timings:
+        timings[name] = seconds
+        print(f"Startup timing: {name} {seconds:.3f}s")
+
+# Cumulative latency histogram with Prometheus-style buckets
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    # Estimates a quantile by interpolating inside the bucket that holds it;
+    # the overflow bucket reaches up to the slowest observation, so the tail
+    # is never capped at the last bound
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for index, bucket_count in enumerate(self.counts):
+            upper = self.buckets[index] if index < len(self.buckets) else self.max
+            if bucket_count and seen + bucket_count >= rank:
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, self.max)
+            seen += bucket_count
+            lower = upper
+        return self.max
+
+# Process-wide registry of latency histograms and counters. Cache hit ratios
+# and startup timings are collected as gauges when the metrics are rendered
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = []
+
+    def observe(self, name, labels, seconds):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, labels, amount=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + amount
+
+    @contextmanager
+    def timer(self, name, labels):
+        started = time.perf_counter()
         try:
-            pygame.mixer.init()
-            pygame.mixer.music.load('trade.mp3')
-            pygame.mixer.music.play(-1)
-            st.session_state['music_initialized'] = True
-        except pygame.error as e:
-            st.error(f"Failed to load or play the music: {str(e)}. Please check that 'trade.mp3' exists in the correct directory.")
-
-# Database setup
-def setup_database():
-    conn = sqlite3.connect('trading_game.db', check_same_thread=False)
-    cursor = conn.cursor()
-
-    # Create tables if they don't exist
-    cursor.execute('''
+            yield
+        except Exception:
+            self.increment(name.replace('_seconds', '_errors_total'), labels)
+            raise
+        finally:
+            self.observe(name, labels, time.perf_counter() - started)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def gauges(self):
+        gauges = []
+        for collector in self.collectors:
+            try:
+                gauges.extend(collector())
+            except Exception as e:
+                print(f"Error collecting metrics: {str(e)}")
+        return gauges
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            for (name, labels), histogram in histograms:
+                describe(name, 'histogram')
+                label_text = format_labels(labels)
+                cumulative = 0
+                for bound, bucket_count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{label_text} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{label_text} {histogram.count}')
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for name, labels, value in sorted(self.gauges()):
+            describe(name, 'gauge')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    # One row per timed call, query or panel, for the Diagnostics page
+    def summary(self):
+        with self.lock:
+            rows = [{
+                'Metric': name.replace('charging_bull_', '').replace('_seconds', ''),
+                'Name': dict(labels).get('name', ''),
+                'Calls': histogram.count,
+                'Errors': self.counters.get((name.replace('_seconds', '_errors_total'), labels), 0),
+                'Mean (ms)': histogram.sum / histogram.count * 1000 if histogram.count else 0.0,
+                'p50 (ms)': histogram.quantile(0.5) * 1000,
+                'p99 (ms)': histogram.quantile(0.99) * 1000,
+                'Max (ms)': histogram.max * 1000
+            } for (name, labels), histogram in self.histograms.items()]
+        return pd.DataFrame(rows)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+# Function to report cache sizes and hit ratios as gauges
+def collect_cache_metrics():
+    caches = {
+        'quotes': get_quote_cache().stats(),
+        'portfolios': get_portfolio_cache().stats(),
+        'exchange_rates': get_fx_table().stats(),
+        'news': get_news_service().cache.stats()
+    }
+    gauges = []
+    for cache, stats in caches.items():
+        for field in ('hits', 'misses', 'hit_ratio'):
+            gauges.append((f'charging_bull_cache_{field}', (('cache', cache),), stats[field]))
+    for phase, seconds in get_startup_timings().items():
+        gauges.append(('charging_bull_startup_seconds', (('phase', phase),), f'{seconds:.6f}'))
+    return gauges
+
+@process_resource
+def get_metrics():
+    metrics = Metrics()
+    metrics.add_collector(collect_cache_metrics)
+    return metrics
+
+# Decorator recording the latency and errors of every call to a function
+def instrumented(name, metric='charging_bull_call_seconds'):
+    labels = (('name', name),)
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().timer(metric, labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Decorator timing each rerun of a page panel
+def timed_panel(name):
+    return instrumented(name, metric='charging_bull_panel_seconds')
+
+# SQLite connection that times every statement run through execute or
+# executemany, labelled with the statement text
+class InstrumentedConnection(sqlite3.Connection):
+    def execute(self, sql, *args):
+        with get_metrics().timer('charging_bull_query_seconds', (('name', query_label(sql)),)):
+            return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        with get_metrics().timer('charging_bull_query_seconds', (('name', query_label(sql)),)):
+            return super().executemany(sql, *args)
+
+@functools.lru_cache(maxsize=512)
+def query_label(sql):
+    return re.sub(r'\s+', ' ', sql).strip()[:160]
+
+# Daemon thread writing the metrics to METRICS_FILE in the Prometheus text
+# format, for a node_exporter textfile collector or any scraper
+class MetricsExporter(threading.Thread):
+    def __init__(self, path=METRICS_FILE, interval=METRICS_EXPORT_INTERVAL):
+        super().__init__(name='metrics-exporter', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                temporary = f"{self.path}.tmp"
+                with open(temporary, 'w') as metrics_file:
+                    metrics_file.write(get_metrics().render())
+                os.replace(temporary, self.path)
+            except Exception as e:
+                print(f"Error exporting metrics: {str(e)}")
+
+@process_resource
+def start_metrics_exporter():
+    exporter = MetricsExporter()
+    exporter.start()
+    return exporter
+
+# Process-wide pool of SQLite connections in WAL mode; connections are
+# shared between Streamlit's script threads, one borrower at a time
+class ConnectionPool:
+    def __init__(self, path=DATABASE_PATH, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.overflow = 0
+        self.lock = threading.Lock()
+
+    def open_connection(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                               factory=InstrumentedConnection)
+        conn.execute("PRAGMA journal_mode = WAL")
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    # Waits up to DB_POOL_WAIT for an idle connection once the pool is full,
+    # then opens an overflow connection rather than failing the caller
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return self.open_connection()
+        try:
+            return self.idle.get(timeout=DB_POOL_WAIT)
+        except queue.Empty:
+            with self.lock:
+                self.overflow += 1
+            return self.open_connection()
+
+    # Overflow connections are closed once the pool has enough idle ones
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self.idle.qsize() >= self.size:
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+def migrate_v1_initial_schema(c):
+    c.execute('''
     CREATE TABLE IF NOT EXISTS users (
         username TEXT PRIMARY KEY,
         password TEXT,
@@ -63,7 +481,7 @@ def setup_database():
     )
     ''')
 
-    cursor.execute('''
+    c.execute('''
     CREATE TABLE IF NOT EXISTS portfolios (
         username TEXT,
         ticker TEXT,
@@ -74,7 +492,7 @@ def setup_database():
     )
     ''')
 
-    cursor.execute('''
+    c.execute('''
     CREATE TABLE IF NOT EXISTS financial_logs (
         username TEXT,
         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
@@ -83,7 +501,7 @@ def setup_database():
     )
     ''')
 
-    cursor.execute('''
+    c.execute('''
     CREATE TABLE IF NOT EXISTS transactions (
         username TEXT,
         action TEXT,
@@ -94,103 +512,469 @@ def setup_database():
     )
     ''')
 
-    conn.commit()
-    return conn
+    # Databases created by older versions may lack these columns
+    c.execute("PRAGMA table_info(users)")
+    columns = [column[1] for column in c.fetchall()]
+    if 'initial_balance' not in columns:
+        c.execute(f"ALTER TABLE users ADD COLUMN initial_balance REAL DEFAULT {INITIAL_BALANCE}")
 
-# Ensure Database Schema
-def ensure_database_schema():
-    conn = sqlite3.connect('trading_game.db')
-    c = conn.cursor()
-    
-    # Ensure the users table exists and has the required columns
+    c.execute("PRAGMA table_info(portfolios)")
+    columns = [column[1] for column in c.fetchall()]
+    if 'initial_investment' not in columns:
+        c.execute("ALTER TABLE portfolios ADD COLUMN initial_investment REAL")
+
+def migrate_v2_price_history(c):
     c.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        username TEXT PRIMARY KEY,
-        password TEXT,
-        balance REAL,
-        initial_balance REAL,
-        currency TEXT DEFAULT 'USD'
+    CREATE TABLE IF NOT EXISTS price_history (
+        ticker TEXT,
+        date TEXT,
+        open REAL,
+        high REAL,
+        low REAL,
+        close REAL,
+        volume REAL,
+        PRIMARY KEY (ticker, date)
+    ) WITHOUT ROWID
+    ''')
+
+    # covered_from is the earliest date requested from upstream; NULL once
+    # the full history has been stored
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS price_history_meta (
+        ticker TEXT PRIMARY KEY,
+        covered_from TEXT,
+        last_date TEXT
     )
     ''')
 
-    # Check if the initial_balance column exists, if not, add it
+def migrate_v3_financial_log_rollups(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_financial_logs_timestamp ON financial_logs (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_financial_logs_user ON financial_logs (username, timestamp)")
+
+    for table in ('financial_logs_hourly', 'financial_logs_daily'):
+        c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            username TEXT,
+            bucket TEXT,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            samples INTEGER,
+            PRIMARY KEY (username, bucket)
+        ) WITHOUT ROWID
+        ''')
+        c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table} (bucket)")
+
+# users.version is bumped by every committed trade
+def migrate_v4_user_version(c):
     c.execute("PRAGMA table_info(users)")
     columns = [column[1] for column in c.fetchall()]
-    if 'initial_balance' not in columns:
-        c.execute(f"ALTER TABLE users ADD COLUMN initial_balance REAL DEFAULT {INITIAL_BALANCE}")
-        conn.commit()
+    if 'version' not in columns:
+        c.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
 
-    # Ensure the portfolios table exists and has the required columns
+def migrate_v5_transaction_index(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_time ON transactions (username, timestamp)")
+
+# Older versions stored tickers as typed; orders now always store them upper
+# case, so fold any lower or mixed case holdings into the upper case rows
+def migrate_v6_upper_case_tickers(c):
+    c.execute("""
+    INSERT INTO portfolios (username, ticker, shares, initial_investment)
+    SELECT username, UPPER(ticker), SUM(shares), SUM(initial_investment)
+    FROM portfolios
+    WHERE ticker != UPPER(ticker)
+    GROUP BY username, UPPER(ticker)
+    ON CONFLICT (username, ticker) DO UPDATE SET
+        shares = shares + excluded.shares,
+        initial_investment = initial_investment + excluded.initial_investment
+    """)
+    c.execute("DELETE FROM portfolios WHERE ticker != UPPER(ticker)")
+    c.execute("UPDATE transactions SET ticker = UPPER(ticker) WHERE ticker != UPPER(ticker)")
+
+# Per player and ticker running totals for the average cost method, kept up
+# to date by the order engine; existing trades are replayed once to fill it
+def migrate_v7_position_costs(c):
     c.execute('''
-    CREATE TABLE IF NOT EXISTS portfolios (
+    CREATE TABLE IF NOT EXISTS position_costs (
         username TEXT,
         ticker TEXT,
-        shares REAL,
-        initial_investment REAL,
-        PRIMARY KEY (username, ticker),
-        FOREIGN KEY (username) REFERENCES users (username)
-    )
+        shares REAL NOT NULL DEFAULT 0,
+        cost REAL NOT NULL DEFAULT 0,
+        realized_pnl REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (username, ticker)
+    ) WITHOUT ROWID
     ''')
+    c.execute("SELECT username, action, ticker, amount, price FROM transactions "
+              "ORDER BY username, ticker, timestamp, rowid")
+    for username, action, ticker, amount, price in c.fetchall():
+        record_position_cost(c, username, action, ticker, amount, price)
 
-    # Check if the initial_investment column exists, if not, add it
-    c.execute("PRAGMA table_info(portfolios)")
-    columns = [column[1] for column in c.fetchall()]
-    if 'initial_investment' not in columns:
-        c.execute(f"ALTER TABLE portfolios ADD COLUMN initial_investment REAL")
-        conn.commit()
+MIGRATIONS = [
+    migrate_v1_initial_schema,
+    migrate_v2_price_history,
+    migrate_v3_financial_log_rollups,
+    migrate_v4_user_version,
+    migrate_v5_transaction_index,
+    migrate_v6_upper_case_tickers,
+    migrate_v7_position_costs
+]
+
+def migrate_database(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            migration(c)
+            c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
-    conn.close()
+# Database setup: opens the pool and migrates the schema once per process
+@process_resource
+def get_db_pool():
+    pool = ConnectionPool()
+    with pool.connection() as conn:
+        migrate_database(conn)
+    return pool
 
 # Function to hash passwords
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
+# Function to build the background CSS; the image is read and encoded once
+@st.cache_data(show_spinner=False)
+def background_css(image_path):
+    with open(image_path, "rb") as img_file:
+        encoded_img = base64.b64encode(img_file.read()).decode('utf-8')
+    return f"""
+    <style>
+    .stApp {{
+        position: relative;
+        background-image: url(data:image/png;base64,{encoded_img});
+        background-size: cover;
+        background-position: center;
+        background-repeat: no-repeat;
+    }}
+    .stApp::before {{
+        content: '';
+        position: absolute;
+        top: 0;
+        left: 0;
+        right: 0;
+        bottom: 0;
+        background-color: rgba(255, 255, 255, 0.8); /* White overlay with 0.8 opacity */
+        z-index: 0;
+    }}
+    .main-title, .sub-title, .metric-box, .blue-background {{
+        position: relative;
+        z-index: 1;
+    }}
+    </style>
+    """
+
 # Function to set the background image
 def set_background_image(image_path):
     if Path(image_path).exists():
         try:
-            with open(image_path, "rb") as img_file:
-                encoded_img = base64.b64encode(img_file.read()).decode('utf-8')
-                st.markdown(
-                    f"""
-                    <style>
-                    .stApp {{
-                        position: relative;
-                        background-image: url(data:image/png;base64,{encoded_img});
-                        background-size: cover;
-                        background-position: center;
-                        background-repeat: no-repeat;
-                    }}
-                    .stApp::before {{
-                        content: '';
-                        position: absolute;
-                        top: 0;
-                        left: 0;
-                        right: 0;
-                        bottom: 0;
-                        background-color: rgba(255, 255, 255, 0.8); /* White overlay with 0.8 opacity */
-                        z-index: 0;
-                    }}
-                    .main-title, .sub-title, .metric-box, .blue-background {{
-                        position: relative;
-                        z-index: 1;
-                    }}
-                    </style>
-                    """,
-                    unsafe_allow_html=True
-                )
+            st.markdown(background_css(image_path), unsafe_allow_html=True)
         except Exception as e:
             st.error(f"Error loading image: {str(e)}")
     else:
         st.error('Image not found. Please check the file name and path.')
 
+# Function to read a static image once instead of on every rerun
+@st.cache_data(show_spinner=False)
+def load_image(image_path):
+    return Path(image_path).read_bytes()
+
+# Process-wide LRU cache for price history, keyed by (ticker, period)
+class QuoteCache:
+    def __init__(self, max_size=QUOTE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def peek(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+# Shared across every session and rerun of the server process
+@process_resource
+def get_quote_cache():
+    return QuoteCache()
+
+# Coalesces identical concurrent upstream requests: the first caller for a
+# key runs the fetch, later callers wait for and share its result or error
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fetch, timeout=SINGLE_FLIGHT_TIMEOUT):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+        if not leader:
+            return future.result(timeout=timeout)
+        try:
+            result = fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+@process_resource
+def get_single_flight():
+    return SingleFlight()
+
+# Market data from the live services. Histories come back with the index
+# as a Date column; download returns yfinance's frame grouped by ticker
+class LiveProvider:
+    news_requires_key = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session = None
+        self.news_clients = {}
+
+    @instrumented('upstream.history')
+    def history(self, ticker, **kwargs):
+        from yfinance import Ticker
+        df = Ticker(ticker).history(**kwargs)
+        df.reset_index(inplace=True)
+        return df
+
+    @instrumented('upstream.download')
+    def download(self, tickers, period='1d'):
+        from yfinance import download
+        return download(tickers, period=period, group_by='ticker', auto_adjust=True,
+                        threads=True, progress=False)
+
+    @instrumented('upstream.exchange_rates')
+    def exchange_rates(self, base):
+        response = self.http_session().get(FX_API_URL.format(base=base), timeout=FX_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return dict(response.json()['rates'])
+
+    @instrumented('upstream.news')
+    def news(self, api_key, query, language='en', page_size=5):
+        return self.news_client(api_key).get_everything(q=query, language=language, sort_by='publishedAt',
+                                                        page_size=page_size)
+
+    # One pooled HTTP session for every exchange-rate request
+    def http_session(self):
+        with self.lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                self.session.mount('https://', adapter)
+            return self.session
+
+    def news_client(self, api_key):
+        with self.lock:
+            newsapi = self.news_clients.get(api_key)
+            if newsapi is None:
+                from newsapi import NewsApiClient
+                newsapi = NewsApiClient(api_key=api_key)
+                self.news_clients[api_key] = newsapi
+            return newsapi
+
+# Deterministic market data for offline runs and benchmarks. Serves
+# fixtures from FIXTURES_DIR: history/<TICKER>.csv daily bars,
+# fx/<BASE>.json rate tables and news/<QUERY>.json search results.
+# Recorded bars are moved onto the business days ending today, so period
+# windows still line up however old the recording is. Anything without a
+# fixture gets a random walk seeded from its name
+class ReplayProvider:
+    news_requires_key = False
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR):
+        self.fixtures_dir = Path(fixtures_dir)
+        self.lock = threading.Lock()
+        self.bars = {}
+
+    @instrumented('upstream.history')
+    def history(self, ticker, period=None, start=None, **kwargs):
+        return self.window(self.daily_bars(ticker), period, start).reset_index(drop=True)
+
+    @instrumented('upstream.download')
+    def download(self, tickers, period='1d'):
+        if isinstance(tickers, str):
+            tickers = tickers.split()
+        return pd.concat({ticker: self.window(self.daily_bars(ticker), period).set_index('Date')
+                          for ticker in tickers}, axis=1)
+
+    @instrumented('upstream.exchange_rates')
+    def exchange_rates(self, base):
+        fixture = self.read_json('fx', base)
+        if fixture is not None:
+            return dict(fixture['rates'])
+        usd_per_base = 1 / SYNTHETIC_USD_RATES.get(base, 1.0)
+        return {currency: rate * usd_per_base for currency, rate in SYNTHETIC_USD_RATES.items()}
+
+    @instrumented('upstream.news')
+    def news(self, api_key, query, language='en', page_size=5):
+        fixture = self.read_json('news', query)
+        if fixture is not None:
+            return dict(fixture, articles=fixture['articles'][:page_size])
+        published = pd.Timestamp.today().normalize()
+        return {'status': 'ok', 'totalResults': page_size, 'articles': [{
+            'title': f"{query} headline {number}",
+            'description': f"Replayed article {number} about {query}.",
+            'url': f"https://example.com/news/{query}/{number}",
+            'publishedAt': (published - pd.Timedelta(hours=number)).isoformat()
+        } for number in range(1, page_size + 1)]}
+
+    def daily_bars(self, ticker):
+        key = (ticker.upper(), pd.Timestamp.today().normalize())
+        with self.lock:
+            df = self.bars.get(key)
+            if df is None:
+                df = self.bars[key] = self.load_bars(*key)
+        return df
+
+    def load_bars(self, ticker, today):
+        path = self.fixtures_dir / 'history' / f"{ticker}.csv"
+        if path.exists():
+            df = pd.read_csv(path, parse_dates=['Date'])
+            df['Date'] = pd.bdate_range(end=today, periods=len(df))
+            return df
+        return synthetic_bars(ticker, today)
+
+    @staticmethod
+    def window(df, period=None, start=None):
+        if start is not None:
+            return df[df['Date'] >= pd.Timestamp(start)]
+        if period in ('1d', '5d'):
+            return df.tail(int(period[0]))
+        offset = HISTORY_PERIODS.get(period)
+        if offset is not None:
+            return df[df['Date'] >= df['Date'].iloc[-1] - offset]
+        return df
+
+    def read_json(self, kind, name):
+        path = self.fixtures_dir / kind / f"{fixture_name(name)}.json"
+        if not path.exists():
+            return None
+        with open(path) as fixture:
+            return json.load(fixture)
+
+# Function to build a reproducible daily price series for a ticker; a bar's
+# price depends only on its position since SYNTHETIC_HISTORY_START
+def synthetic_bars(ticker, today):
+    dates = pd.bdate_range(SYNTHETIC_HISTORY_START, today)
+    rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+    first_price = rng.uniform(20, 400)
+    closes = first_price * np.exp(np.cumsum(rng.normal(0.0002, 0.018, len(dates))))
+    opens = np.concatenate(([first_price], closes[:-1]))
+    spread = np.abs(rng.normal(0, 0.006, len(dates)))
+    return pd.DataFrame({
+        'Date': dates,
+        'Open': opens,
+        'High': np.maximum(opens, closes) * (1 + spread),
+        'Low': np.minimum(opens, closes) * (1 - spread),
+        'Close': closes,
+        'Volume': rng.integers(100000, 10000000, len(dates))
+    })
+
+def fixture_name(name):
+    return re.sub(r'[^A-Za-z0-9=._-]+', '_', name)
+
+# Function to save the live services' answers as ReplayProvider fixtures
+def record_fixtures(fixtures_dir, tickers, currencies, queries=(), api_key=None):
+    live = LiveProvider()
+    fixtures_dir = Path(fixtures_dir)
+    for kind in ('history', 'fx', 'news'):
+        (fixtures_dir / kind).mkdir(parents=True, exist_ok=True)
+    for ticker in tickers:
+        df = live.history(ticker, period='max', auto_adjust=True)
+        if df.empty:
+            print(f"No history recorded for {ticker}")
+            continue
+        df['Date'] = df['Date'].dt.strftime('%Y-%m-%d')
+        df[['Date', 'Open', 'High', 'Low', 'Close', 'Volume']].to_csv(
+            fixtures_dir / 'history' / f"{fixture_name(ticker)}.csv", index=False)
+    for base in currencies:
+        with open(fixtures_dir / 'fx' / f"{fixture_name(base)}.json", 'w') as fixture:
+            json.dump({'base': base, 'rates': live.exchange_rates(base)}, fixture)
+    for query in queries if api_key else ():
+        with open(fixtures_dir / 'news' / f"{fixture_name(query)}.json", 'w') as fixture:
+            json.dump(live.news(api_key, query, page_size=20), fixture)
+
+DATA_PROVIDERS = {'live': LiveProvider, 'replay': ReplayProvider}
+
+@process_resource
+def get_data_provider():
+    provider = DATA_PROVIDERS.get(DATA_PROVIDER)
+    if provider is None:
+        print(f"Unknown data provider {DATA_PROVIDER!r}, using live data")
+        provider = LiveProvider
+    return provider()
+
 # Function to fetch the current price of stocks or currencies
+@instrumented('get_stock_data')
 def get_stock_data(ticker, period='1d'):
+    cache = get_quote_cache()
+    key = (ticker.upper(), period)
+    df = cache.get(key)
+    if df is not None:
+        return df
     try:
-        stock = Ticker(ticker)
-        df = stock.history(period=period)
-        if not df.empty:
-            df.reset_index(inplace=True)
+        if period in HISTORY_PERIODS:
+            df = get_stored_history(ticker.upper(), period)
+        else:
+            df = get_single_flight().do(('history', key[0], period),
+                                        lambda: get_data_provider().history(ticker, period=period))
+        if df is not None and not df.empty:
+            cache.put(key, df, QUOTE_CACHE_TTL.get(period, DEFAULT_QUOTE_TTL))
             return df
         else:
             return None
@@ -198,39 +982,345 @@ def get_stock_data(ticker, period='1d'):
         print(f"Error fetching data: {str(e)}")
         return None
 
+# Function to download daily bars for the history store, coalescing
+# identical concurrent requests
+def fetch_history(ticker, fetch_kwargs):
+    try:
+        return get_single_flight().do(('history', ticker, tuple(fetch_kwargs.items())),
+                                      lambda: get_data_provider().history(ticker, auto_adjust=True, **fetch_kwargs))
+    except Exception as e:
+        print(f"Error fetching data: {str(e)}")
+        return None
+
+# Function to bring the local daily bars for a ticker up to date. Only the
+# bars since the last stored one are downloaded, unless the requested range
+# starts before anything stored so far. No connection is held during the
+# download, so a slow fetch never ties up the pool
+def sync_history(ticker, start):
+    pool = get_db_pool()
+    with pool.connection() as conn:
+        meta = conn.execute(
+            "SELECT m.covered_from, m.last_date, h.close FROM price_history_meta m "
+            "LEFT JOIN price_history h ON h.ticker = m.ticker AND h.date = m.last_date WHERE m.ticker = ?",
+            (ticker,)).fetchone()
+    incremental = not (meta is None or (meta[0] is not None and (start is None or start < meta[0])))
+    if incremental:
+        covered_from = meta[0]
+        fetch_kwargs = {'start': meta[1]}
+    else:
+        covered_from = start
+        fetch_kwargs = {'period': 'max'} if start is None else {'start': start}
+
+    df = fetch_history(ticker, fetch_kwargs)
+    if df is None or df.empty:
+        return
+    dates = df['Date'].dt.strftime('%Y-%m-%d')
+
+    # The incremental fetch starts at the last stored bar. If its close has
+    # moved, a split or dividend has re-adjusted every earlier close too, so
+    # the whole covered range is downloaded again and replaces the old bars
+    refetch = False
+    if incremental and meta[2] is not None:
+        overlap = df['Close'][(dates == meta[1]).to_numpy()]
+        if len(overlap) and not np.isclose(overlap.iloc[0], meta[2]):
+            refetch = True
+            df = fetch_history(ticker, {'period': 'max'} if covered_from is None else {'start': covered_from})
+            if df is None or df.empty:
+                return
+            dates = df['Date'].dt.strftime('%Y-%m-%d')
+
+    rows = list(zip([ticker] * len(df), dates, df['Open'], df['High'], df['Low'], df['Close'], df['Volume']))
+    with pool.connection() as conn:
+        with conn:
+            if refetch:
+                conn.execute("DELETE FROM price_history WHERE ticker = ? AND date >= ?", (ticker, dates.iloc[0]))
+            conn.executemany("INSERT OR REPLACE INTO price_history VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            # Another sync of the same ticker may have finished meanwhile, so
+            # coverage only ever widens
+            conn.execute("""
+            INSERT INTO price_history_meta VALUES (?, ?, ?)
+            ON CONFLICT (ticker) DO UPDATE SET
+                covered_from = CASE
+                    WHEN covered_from IS NULL OR excluded.covered_from IS NULL THEN NULL
+                    ELSE MIN(covered_from, excluded.covered_from)
+                END,
+                last_date = MAX(last_date, excluded.last_date)
+            """, (ticker, covered_from, dates.iloc[-1]))
+
+# Function to serve a HISTORY_PERIODS range from the local history store
+def get_stored_history(ticker, period):
+    return get_single_flight().do(('stored_history', ticker, period),
+                                  lambda: read_stored_history(ticker, period))
+
+def read_stored_history(ticker, period):
+    offset = HISTORY_PERIODS[period]
+    start = (pd.Timestamp.today().normalize() - offset).strftime('%Y-%m-%d') if offset is not None else None
+    sync_history(ticker, start)
+    with get_db_pool().connection() as conn:
+        df = pd.read_sql_query(
+            "SELECT date AS Date, open AS Open, high AS High, low AS Low, close AS Close, volume AS Volume "
+            "FROM price_history WHERE ticker = ? AND date >= ? ORDER BY date",
+            conn, params=(ticker, start or ''), parse_dates=['Date'])
+    return df if not df.empty else None
+
+# Function to download several tickers in one round trip, bypassing the
+# quote cache; every frame fetched is stored back into it
+def download_stock_data(tickers, period='1d'):
+    cache = get_quote_cache()
+    frames = {}
+    try:
+        raw = get_single_flight().do(
+            ('download', tuple(tickers), period),
+            lambda: get_data_provider().download(tickers, period))
+    except Exception as e:
+        print(f"Error fetching data: {str(e)}")
+        return frames
+    if raw is None or raw.empty:
+        return frames
+    for ticker in tickers:
+        if isinstance(raw.columns, pd.MultiIndex):
+            if ticker not in raw.columns.get_level_values(0):
+                continue
+            df = raw[ticker]
+        else:
+            df = raw
+        df = df.dropna(how='all')
+        if df.empty:
+            continue
+        df = df.reset_index()
+        df.columns.name = None
+        cache.put((ticker, period), df, QUOTE_CACHE_TTL.get(period, DEFAULT_QUOTE_TTL))
+        frames[ticker] = df
+    return frames
+
+# Function to fetch several tickers in one round trip; returns a single
+# long-format DataFrame with a 'Ticker' column
+@instrumented('get_stock_data_batch')
+def get_stock_data_batch(tickers, period='1d'):
+    cache = get_quote_cache()
+    tickers = list(dict.fromkeys(t.upper() for t in tickers if t))
+    frames = {}
+    missing = []
+    for ticker in tickers:
+        df = cache.get((ticker, period))
+        if df is not None:
+            frames[ticker] = df
+        else:
+            missing.append(ticker)
+
+    if missing and period in HISTORY_PERIODS:
+        for ticker in missing:
+            try:
+                df = get_stored_history(ticker, period)
+            except Exception as e:
+                print(f"Error fetching data: {str(e)}")
+                continue
+            if df is not None:
+                cache.put((ticker, period), df, QUOTE_CACHE_TTL.get(period, DEFAULT_QUOTE_TTL))
+                frames[ticker] = df
+    elif missing:
+        frames.update(download_stock_data(missing, period))
+
+    if not frames:
+        return pd.DataFrame(columns=['Ticker', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume'])
+    return pd.concat(
+        [df.assign(Ticker=ticker) for ticker, df in frames.items()],
+        ignore_index=True
+    )
+
+# Function to get the session open and latest close for several tickers at once
+def get_latest_quotes(tickers):
+    tickers = list(dict.fromkeys(t.upper() for t in tickers if t))
+    snapshot = get_market_snapshot()
+    quotes = {}
+    if snapshot is not None:
+        quotes = {t: snapshot.quotes[t] for t in tickers if t in snapshot.quotes}
+    missing = [t for t in tickers if t not in quotes]
+    if missing:
+        df = get_stock_data_batch(missing, period='1d')
+        if not df.empty:
+            grouped = df.groupby('Ticker', sort=False)
+            first_open = grouped['Open'].first()
+            last_close = grouped['Close'].last()
+            for ticker in first_open.index:
+                quotes[ticker] = (first_open[ticker], last_close[ticker])
+    return pd.DataFrame.from_dict(quotes, orient='index', columns=['Open', 'Close'])
+
+# Immutable view of the market published by the background refresher
+MarketSnapshot = namedtuple('MarketSnapshot', ['timestamp', 'quotes', 'fx_rates', 'gold_price'])
+
+# Daemon thread that polls every ticker the game cares about once per
+# UPDATE_INTERVAL, so page renders read prices from memory
+class MarketRefresher(threading.Thread):
+    def __init__(self, interval=UPDATE_INTERVAL):
+        super().__init__(name='market-refresher', daemon=True)
+        self.interval = interval
+        self.snapshot = None
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing market data: {str(e)}")
+            self.stop_event.wait(self.interval)
+
+    def tracked_tickers(self):
+        tickers = list(STOCK_LIST) + [GOLD_TICKER]
+        try:
+            with get_db_pool().connection() as conn:
+                rows = conn.execute("SELECT DISTINCT ticker FROM portfolios WHERE shares > 0").fetchall()
+            tickers.extend(row[0].upper() for row in rows if row[0])
+        except sqlite3.Error as e:
+            print(f"Error reading held tickers: {str(e)}")
+        return list(dict.fromkeys(tickers))
+
+    def refresh(self):
+        frames = download_stock_data(self.tracked_tickers(), period='1d')
+        fx_table = get_fx_table()
+        fx_table.invalidate('USD')
+        fx_rates = fx_table.get_rates('USD')
+        previous = self.snapshot
+        quotes = dict(previous.quotes) if previous is not None else {}
+        for ticker, df in frames.items():
+            quotes[ticker] = (df['Open'].iloc[0], df['Close'].iloc[-1])
+        gold = quotes.get(GOLD_TICKER)
+        self.snapshot = MarketSnapshot(
+            timestamp=time.time(),
+            quotes=MappingProxyType(quotes),
+            fx_rates=MappingProxyType(dict(fx_rates)),
+            gold_price=gold[1] if gold is not None else None
+        )
+
+@process_resource
+def start_market_refresher():
+    refresher = MarketRefresher()
+    refresher.start()
+    return refresher
+
+# Function to read the latest published snapshot; None while the first poll
+# is still running or when the refresher has fallen too far behind
+def get_market_snapshot():
+    snapshot = start_market_refresher().snapshot
+    if snapshot is None or time.time() - snapshot.timestamp > SNAPSHOT_MAX_AGE:
+        return None
+    return snapshot
+
+# In-memory exchange-rate table, fetched once per base currency and
+# refreshed after FX_RATES_TTL seconds
+class FxRateTable:
+    def __init__(self, ttl=FX_RATES_TTL):
+        self.ttl = ttl
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_rates(self, base):
+        with self.lock:
+            entry = self.tables.get(base)
+            fresh = entry is not None and entry[0] > time.monotonic()
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if fresh:
+            return entry[1]
+        try:
+            rates = self.fetch(base)
+        except Exception as e:
+            print(f"Error fetching exchange rates: {str(e)}")
+            # Serve stale rates rather than none at all
+            return entry[1] if entry is not None else {}
+        with self.lock:
+            self.tables[base] = (time.monotonic() + self.ttl, rates)
+        return rates
+
+    def invalidate(self, base):
+        with self.lock:
+            entry = self.tables.get(base)
+            if entry is not None:
+                self.tables[base] = (0, entry[1])
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.tables),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+    def fetch(self, base):
+        return get_single_flight().do(('fx', base), lambda: get_data_provider().exchange_rates(base))
+
+@process_resource
+def get_fx_table():
+    return FxRateTable()
+
 # Function to convert currency
+@instrumented('convert_currency')
 def convert_currency(amount, from_currency, to_currency):
     if from_currency == to_currency:
         return amount
-    try:
-        response = requests.get(f'https://api.exchangerate-api.com/v4/latest/{from_currency}')
-        rates = response.json()['rates']
-        conversion_rate = rates.get(to_currency, 1)
-        return amount * conversion_rate
-    except Exception as e:
-        print(f"Error converting currency: {str(e)}")
-        return amount
+    rates = get_fx_table().get_rates(from_currency)
+    return amount * rates.get(to_currency, 1)
 
 # Function to get market status
 def get_market_status():
+    quotes = get_latest_quotes(STOCK_LIST)
     market_status = {}
     for ticker in STOCK_LIST:
-        df = get_stock_data(ticker, period='1d')
-        if df is not None:
-            open_price = df['Open'].iloc[0]
-            current_price = df['Close'].iloc[-1]
+        if ticker in quotes.index:
+            open_price = quotes.at[ticker, 'Open']
+            current_price = quotes.at[ticker, 'Close']
             change = (current_price - open_price) / open_price * 100
             market_status[ticker] = change
     return market_status
 
+# Function to downsample a series with min/max bucketing: the series is split
+# into width // 2 equal buckets and each keeps its lowest and highest point,
+# which preserves the visible envelope of the line
+def downsample_minmax(x, y, width=CHART_WIDTH_PX):
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    keep = ~np.isnan(y)
+    x, y = x[keep], y[keep]
+    n = len(y)
+    buckets = max(width // 2, 1)
+    if n <= 2 * buckets:
+        return x, y
+
+    size = -(-n // buckets)
+    buckets = -(-n // size)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(buckets, size)
+    offsets = np.arange(buckets) * size
+    lows = offsets + np.nanargmin(padded, axis=1)
+    highs = offsets + np.nanargmax(padded, axis=1)
+    index = np.unique(np.concatenate(([0, n - 1], lows, highs)))
+    return x[index], y[index]
+
+# Function to build a WebGL line trace from a downsampled Close series
+def price_trace(df, name):
+    import plotly.graph_objects as go
+    x, y = downsample_minmax(df['Date'], df['Close'])
+    return go.Scattergl(x=x, y=y, mode='lines', name=name)
+
 # Function to fetch and plot historical data for holdings
 def plot_holdings(holdings, time_range):
-    fig = px.line(title=f"Holdings - {time_range}")
+    import plotly.graph_objects as go
+    fig = go.Figure(layout_title_text=f"Holdings - {time_range}")
+    history = get_stock_data_batch(list(holdings), period=TIME_RANGES[time_range])
+    frames = dict(tuple(history.groupby('Ticker', sort=False)))
     for ticker in holdings:
-        df = get_stock_data(ticker, period=TIME_RANGES[time_range])
+        df = frames.get(ticker.upper())
         if df is not None and not df.empty:
             initial_investment = holdings[ticker]['initial_investment']
-            fig.add_scatter(x=df['Date'], y=df['Close'], mode='lines', name=f"{ticker} (Invested: ${initial_investment:.2f})")
+            fig.add_trace(price_trace(df, f"{ticker} (Invested: ${initial_investment:.2f})"))
     st.plotly_chart(fig, use_container_width=True)
 
 # Function to display the market overview ticker
@@ -267,17 +1357,21 @@ def market_overview_ticker(market_status):
 # Function to fetch currency values
 def get_currency_values():
     currencies = ['EUR', 'GBP', 'JPY', 'AUD']
+    snapshot = get_market_snapshot()
+    rates = snapshot.fx_rates if snapshot is not None else get_fx_table().get_rates('USD')
     currency_data = {}
     for currency in currencies:
-        rate = convert_currency(1, 'USD', currency)
-        currency_data[currency] = rate
+        currency_data[currency] = rates.get(currency, 1)
     return currency_data
 
 # Function to fetch gold price from yfinance
+@instrumented('get_gold_price')
 def get_gold_price():
-    gold_ticker = Ticker("GC=F")
-    df = gold_ticker.history(period="1d")
-    if not df.empty:
+    snapshot = get_market_snapshot()
+    if snapshot is not None and snapshot.gold_price is not None:
+        return snapshot.gold_price
+    df = get_stock_data(GOLD_TICKER, period="1d")
+    if df is not None and not df.empty:
         return df['Close'].iloc[-1]
     else:
         st.error("Failed to fetch the gold price.")
@@ -301,109 +1395,1003 @@ def display_financial_overview(username, conn):
     st.markdown(f'<div class="metric-box">Invested Value: ${invested_value:.2f}</div>', unsafe_allow_html=True)
     st.markdown(f'<div class="metric-box">Initial Investment: ${initial_balance:.2f}</div>', unsafe_allow_html=True)
 
-# Reintroducing get_user_data with initial_investment
-def get_user_data(username, conn):
-    c = conn.cursor()
-    c.execute("SELECT balance, currency, initial_balance FROM users WHERE username = ?", (username,))
-    balance, currency, initial_balance = c.fetchone()
+# Compact snapshot of one player's account and holdings at a given version
+class PortfolioState:
+    __slots__ = ('username', 'version', 'balance', 'currency', 'initial_balance',
+                 'tickers', 'shares', 'investments', 'checked_at')
+
+    def __init__(self, username, version, balance, currency, initial_balance, holdings):
+        self.username = username
+        self.version = version
+        self.balance = balance
+        self.currency = currency
+        self.initial_balance = initial_balance
+        self.tickers = tuple(row[0] for row in holdings)
+        self.shares = tuple(row[1] for row in holdings)
+        self.investments = tuple(row[2] for row in holdings)
+        self.checked_at = time.monotonic()
+
+    def portfolio(self):
+        return {ticker: {"shares": shares, "initial_investment": initial_investment}
+                for ticker, shares, initial_investment in zip(self.tickers, self.shares, self.investments)}
+
+# Process-wide LRU of PortfolioState by username. The order engine publishes
+# each new state after committing; an older version never replaces a newer one
+class PortfolioStateCache:
+    def __init__(self, max_size=PORTFOLIO_CACHE_SIZE):
+        self.max_size = max_size
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        with self.lock:
+            state = self.states.get(username)
+            if state is None:
+                self.misses += 1
+                return None
+            self.states.move_to_end(username)
+            self.hits += 1
+            return state
+
+    def publish(self, state):
+        with self.lock:
+            current = self.states.get(state.username)
+            if current is not None and current.version > state.version:
+                return
+            self.states[state.username] = state
+            self.states.move_to_end(state.username)
+            while len(self.states) > self.max_size:
+                self.states.popitem(last=False)
 
-    c.execute("SELECT ticker, shares, initial_investment FROM portfolios WHERE username = ?", (username,))
-    portfolio_data = c.fetchall()
-    portfolio = {ticker: {"shares": shares, "initial_investment": initial_investment} for ticker, shares, initial_investment in portfolio_data}
+    def invalidate(self, username):
+        with self.lock:
+            self.states.pop(username, None)
 
-    return balance, currency, initial_balance, portfolio
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.states),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+@process_resource
+def get_portfolio_cache():
+    return PortfolioStateCache()
+
+# Function to read a player's current state from the database
+def load_portfolio_state(conn, username):
+    user = conn.execute("SELECT balance, currency, initial_balance, version FROM users WHERE username = ?",
+                        (username,)).fetchone()
+    if user is None:
+        return None
+    holdings = conn.execute("SELECT ticker, shares, initial_investment FROM portfolios WHERE username = ?",
+                            (username,)).fetchall()
+    balance, currency, initial_balance, version = user
+    return PortfolioState(username, version, balance, currency, initial_balance, holdings)
+
+# Function to get a player's state, from memory when the cached version is
+# known to be current; the version is re-checked every PORTFOLIO_REVALIDATE_SECONDS
+def get_portfolio_state(username, conn):
+    cache = get_portfolio_cache()
+    state = cache.get(username)
+    if state is not None:
+        if time.monotonic() - state.checked_at < PORTFOLIO_REVALIDATE_SECONDS:
+            return state
+        row = conn.execute("SELECT version FROM users WHERE username = ?", (username,)).fetchone()
+        if row is not None and row[0] == state.version:
+            state.checked_at = time.monotonic()
+            return state
+    state = load_portfolio_state(conn, username)
+    if state is not None:
+        cache.publish(state)
+    return state
+
+# Reintroducing get_user_data with initial_investment
+@instrumented('get_user_data')
+def get_user_data(username, conn):
+    state = get_portfolio_state(username, conn)
+    return state.balance, state.currency, state.initial_balance, state.portfolio()
 
 # Function to calculate total value with comparison to initial investment
 def calculate_total_value(username, conn):
     balance, currency, initial_balance, portfolio = get_user_data(username, conn)
     total_value = balance
     invested_value = 0
-    for ticker, data in portfolio.items():
-        if data['shares'] > 0:
-            stock_data = get_stock_data(ticker, '1d')
-            if stock_data is not None:
-                last_close = stock_data['Close'].iloc[-1]
-                invested_value += last_close * data['shares']
+    held = [ticker for ticker, data in portfolio.items() if data['shares'] > 0]
+    quotes = get_latest_quotes(held)
+    for ticker in held:
+        if ticker.upper() in quotes.index:
+            last_close = quotes.at[ticker.upper(), 'Close']
+            invested_value += last_close * portfolio[ticker]['shares']
     total_value += invested_value
     total_value = convert_currency(total_value, 'USD', currency)
     invested_value = convert_currency(invested_value, 'USD', currency)
     initial_balance_converted = convert_currency(initial_balance, 'USD', currency)
     return total_value, invested_value, initial_balance_converted
 
+# Function to load the users and portfolios tables with one query each
+def load_all_holdings(conn):
+    users = pd.read_sql_query("SELECT username, balance, currency, initial_balance FROM users", conn)
+    holdings = pd.read_sql_query("SELECT username, UPPER(ticker) AS ticker, shares FROM portfolios WHERE shares > 0", conn)
+    return users, holdings
+
+# Function to value every player in one pass by joining their holdings
+# against a price vector. It needs no connection, so callers can release
+# theirs before quotes are fetched. Values follow calculate_total_value and
+# are reported in each player's currency; rows are ranked by return on the
+# initial balance
+@instrumented('value_all_users')
+def value_all_users(users, holdings):
+    prices = get_latest_quotes(holdings['ticker'].unique())['Close']
+    holdings['value'] = holdings['shares'] * holdings['ticker'].map(prices).fillna(0)
+    invested_usd = users['username'].map(holdings.groupby('username')['value'].sum()).fillna(0)
+
+    snapshot = get_market_snapshot()
+    fx_rates = snapshot.fx_rates if snapshot is not None else get_fx_table().get_rates('USD')
+    rates = users['currency'].map(pd.Series(dict(fx_rates), dtype=float)).fillna(1)
+    rates[users['currency'] == 'USD'] = 1
+
+    users['total_value'] = (users['balance'] + invested_usd) * rates
+    users['invested_value'] = invested_usd * rates
+    users['initial_value'] = users['initial_balance'] * rates
+    users['return_pct'] = (users['total_value'] / users['initial_value'] - 1) * 100
+    return users.sort_values('return_pct', ascending=False, ignore_index=True)
+
+# Function to fold a batch of valuations into a rollup table
+def upsert_rollup(conn, table, rows):
+    conn.executemany(
+        f"INSERT INTO {table} (username, bucket, open, high, low, close, samples) VALUES (?, ?, ?, ?, ?, ?, 1) "
+        "ON CONFLICT (username, bucket) DO UPDATE SET high = MAX(high, excluded.high), "
+        "low = MIN(low, excluded.low), close = excluded.close, samples = samples + 1",
+        rows)
+
+# Function to write one valuation of every player to financial_logs and the
+# hourly and daily rollups, then drop a bounded slice of expired rows
+def log_valuations(conn, now=None):
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    valuations = value_all_users(*load_all_holdings(conn))
+    if valuations.empty:
+        return 0
+    usernames = valuations['username'].tolist()
+    values = valuations['total_value'].astype(float).tolist()
+    timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+    hour = now.strftime('%Y-%m-%d %H:00:00')
+    day = now.strftime('%Y-%m-%d')
+    raw_cutoff = (now - pd.Timedelta(hours=RAW_LOG_RETENTION_HOURS)).strftime('%Y-%m-%d %H:%M:%S')
+    hourly_cutoff = (now - pd.Timedelta(days=HOURLY_LOG_RETENTION_DAYS)).strftime('%Y-%m-%d %H:00:00')
+    # Each pass adds one raw row per player, so it must be able to delete at
+    # least as many or the raw log would grow without bound
+    batch_size = max(COMPACTION_BATCH_SIZE, 2 * len(usernames))
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("INSERT INTO financial_logs (username, timestamp, total_value) VALUES (?, ?, ?)",
+                         zip(usernames, [timestamp] * len(usernames), values))
+        upsert_rollup(conn, 'financial_logs_hourly', [(u, hour, v, v, v, v) for u, v in zip(usernames, values)])
+        upsert_rollup(conn, 'financial_logs_daily', [(u, day, v, v, v, v) for u, v in zip(usernames, values)])
+        conn.execute("DELETE FROM financial_logs WHERE rowid IN "
+                     "(SELECT rowid FROM financial_logs WHERE timestamp < ? LIMIT ?)",
+                     (raw_cutoff, batch_size))
+        conn.execute("DELETE FROM financial_logs_hourly WHERE (username, bucket) IN "
+                     "(SELECT username, bucket FROM financial_logs_hourly WHERE bucket < ? LIMIT ?)",
+                     (hourly_cutoff, batch_size))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(usernames)
+
+# Daemon thread logging every player's value each VALUATION_INTERVAL
+class ValuationScheduler(threading.Thread):
+    def __init__(self, interval=VALUATION_INTERVAL):
+        super().__init__(name='valuation-scheduler', daemon=True)
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                with get_db_pool().connection() as conn:
+                    log_valuations(conn)
+            except Exception as e:
+                print(f"Error logging valuations: {str(e)}")
+
+@process_resource
+def start_valuation_scheduler():
+    scheduler = ValuationScheduler()
+    scheduler.start()
+    return scheduler
+
+# Function to read a player's equity curve from the rollup tables
+def get_equity_curve(username, conn, resolution='Daily'):
+    table = 'financial_logs_hourly' if resolution == 'Hourly' else 'financial_logs_daily'
+    return pd.read_sql_query(
+        f"SELECT bucket AS Date, close AS Close FROM {table} WHERE username = ? ORDER BY bucket",
+        conn, params=(username,), parse_dates=['Date'])
+
+# Function to plot a player's equity curve
+def display_equity_curve(username, conn):
+    import plotly.graph_objects as go
+    st.markdown('<div class="sub-title">Performance History</div>', unsafe_allow_html=True)
+    resolution = st.radio("Resolution", ["Hourly", "Daily"], index=1, horizontal=True, key="equity_resolution")
+    curve = get_equity_curve(username, conn, resolution)
+    if curve.empty:
+        st.write("No performance history yet.")
+        return
+    fig = go.Figure(price_trace(curve, "Total Value"))
+    fig.update_layout(title=f"Total Value - {resolution}", xaxis_title='Date', yaxis_title='Total Value')
+    st.plotly_chart(fig, use_container_width=True)
+
+# A priced order waiting for the order engine; price is in USD per share
+Order = namedtuple('Order', ['username', 'action', 'ticker', 'amount', 'price', 'fx_rates'])
+
+# A set of priced orders for one player, applied all-or-nothing
+Basket = namedtuple('Basket', ['username', 'action', 'legs', 'fx_rates'])
+
+# Function to book one trade against the player's position_costs row. A buy
+# adds its USD cost; a sell realizes its proceeds less the average cost of
+# the shares held and removes that cost. SQLite evaluates every SET
+# expression against the row as it was, so one UPDATE applies a sell
+def record_position_cost(conn, username, action, ticker, amount, price):
+    if action == 'Buy':
+        conn.execute(
+            "INSERT INTO position_costs (username, ticker, shares, cost) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (username, ticker) DO UPDATE SET shares = shares + excluded.shares, "
+            "cost = cost + excluded.cost",
+            (username, ticker, amount, amount * price))
+    else:
+        conn.execute(
+            "UPDATE position_costs SET realized_pnl = realized_pnl + :amount * (:price - cost / shares), "
+            "cost = CASE WHEN shares > :amount THEN cost - :amount * cost / shares ELSE 0 END, "
+            "shares = MAX(shares - :amount, 0) "
+            "WHERE username = :username AND ticker = :ticker AND shares > 0",
+            {'username': username, 'ticker': ticker, 'amount': amount, 'price': price})
+
+# Raised inside the order engine when an order fails validation. The engine
+# thread outlives the script run that defined this class, so rejections are
+# returned to the session as messages rather than raised across threads
+class OrderRejected(Exception):
+    pass
+
+# Single writer thread that owns all trade writes. Orders arrive already
+# priced, and each burst waiting in the queue is applied inside one
+# BEGIN IMMEDIATE transaction, with a savepoint per order
+class OrderEngine(threading.Thread):
+    def __init__(self, path=DATABASE_PATH, batch_size=ORDER_BATCH_SIZE):
+        super().__init__(name='order-engine', daemon=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.orders = queue.Queue()
+
+    def submit(self, order, timeout=ORDER_TIMEOUT):
+        future = Future()
+        self.orders.put((order, future))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # Withdraw the order if the engine has not picked it up yet, so a
+            # trade reported as timed out is not applied afterwards
+            future.cancel()
+            raise
+
+    def run(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, isolation_level=None,
+                               check_same_thread=False, factory=InstrumentedConnection)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        while True:
+            batch = [self.orders.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.orders.get_nowait())
+                except queue.Empty:
+                    break
+            # Skip orders withdrawn by a timed-out submit
+            batch = [(order, future) for order, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                self.execute_batch(conn, batch)
+
+    @instrumented('order_engine.batch')
+    def execute_batch(self, conn, batch):
+        results = []
+        touched = set()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for order, future in batch:
+                conn.execute("SAVEPOINT order_leg")
+                try:
+                    results.append((future, self.apply(conn, order), None))
+                    conn.execute("RELEASE order_leg")
+                    touched.add(order.username)
+                except OrderRejected as e:
+                    conn.execute("ROLLBACK TO order_leg")
+                    conn.execute("RELEASE order_leg")
+                    results.append((future, str(e), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO order_leg")
+                    conn.execute("RELEASE order_leg")
+                    results.append((future, None, e))
+            states = [load_portfolio_state(conn, username) for username in touched]
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for username in touched:
+                get_portfolio_cache().invalidate(username)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        # Write-through: sessions see the new balances without a DB read
+        portfolio_cache = get_portfolio_cache()
+        for state in states:
+            portfolio_cache.publish(state)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def apply(self, conn, order):
+        if order.action == 'Basket':
+            return self.apply_basket(conn, order)
+        if order.action == 'Buy':
+            return self.apply_buy(conn, order)
+        return self.apply_sell(conn, order)
+
+    def apply_basket(self, conn, basket):
+        state = load_portfolio_state(conn, basket.username)
+        if state is None:
+            raise OrderRejected("Unknown user.")
+        rate = fx_rate(basket.fx_rates, state.currency)
+        balance = state.balance
+        holdings = {ticker: [shares, investment or 0]
+                    for ticker, shares, investment in zip(state.tickers, state.shares, state.investments)}
+
+        # Validate every leg in order against the running balance and holdings
+        bought = sold = 0
+        for leg in basket.legs:
+            value = leg.price * leg.amount
+            position = holdings.setdefault(leg.ticker, [0, 0])
+            if leg.action == 'Buy':
+                if balance < value * rate:
+                    raise OrderRejected(f"Insufficient funds to buy {leg.amount} shares of {leg.ticker}.")
+                balance -= value * rate
+                position[0] += leg.amount
+                position[1] += value
+                bought += value * rate
+            else:
+                if position[0] < leg.amount:
+                    raise OrderRejected(f"Insufficient shares to sell {leg.amount} shares of {leg.ticker}.")
+                balance += value * rate
+                position[0] -= leg.amount
+                sold += value * rate
+
+        touched = {leg.ticker for leg in basket.legs}
+        conn.execute("UPDATE users SET balance = ?, version = version + 1 WHERE username = ?",
+                     (balance, basket.username))
+        conn.executemany("DELETE FROM portfolios WHERE username = ? AND ticker = ?",
+                         [(basket.username, ticker) for ticker in touched if holdings[ticker][0] == 0])
+        conn.executemany("INSERT OR REPLACE INTO portfolios (username, ticker, shares, initial_investment) VALUES (?, ?, ?, ?)",
+                         [(basket.username, ticker, holdings[ticker][0], holdings[ticker][1])
+                          for ticker in touched if holdings[ticker][0] != 0])
+        conn.executemany("INSERT INTO transactions (username, action, ticker, amount, price) VALUES (?, ?, ?, ?, ?)",
+                         [(basket.username, leg.action, leg.ticker, leg.amount, leg.price) for leg in basket.legs])
+        for leg in basket.legs:
+            record_position_cost(conn, basket.username, leg.action, leg.ticker, leg.amount, leg.price)
+        return (f"Successfully executed {len(basket.legs)} orders: bought ${bought:.2f} and sold ${sold:.2f} "
+                f"{state.currency}")
+
+    def apply_buy(self, conn, order):
+        total_cost = order.price * order.amount
+        user_balance, user_currency = conn.execute(
+            "SELECT balance, currency FROM users WHERE username = ?", (order.username,)).fetchone()
+        total_cost_in_user_currency = total_cost * fx_rate(order.fx_rates, user_currency)
+
+        if user_balance < total_cost_in_user_currency:
+            raise OrderRejected("Insufficient funds.")
+
+        conn.execute("UPDATE users SET balance = balance - ?, version = version + 1 WHERE username = ?",
+                     (total_cost_in_user_currency, order.username))
+        conn.execute(
+            "INSERT INTO portfolios (username, ticker, shares, initial_investment) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (username, ticker) DO UPDATE SET shares = shares + excluded.shares, "
+            "initial_investment = initial_investment + excluded.initial_investment",
+            (order.username, order.ticker, order.amount, total_cost))
+        conn.execute("INSERT INTO transactions (username, action, ticker, amount, price) VALUES (?, ?, ?, ?, ?)",
+                     (order.username, 'Buy', order.ticker, order.amount, order.price))
+        record_position_cost(conn, order.username, 'Buy', order.ticker, order.amount, order.price)
+        return f"Successfully bought {order.amount} shares of {order.ticker} for ${total_cost_in_user_currency:.2f} {user_currency}"
+
+    def apply_sell(self, conn, order):
+        total_value = order.price * order.amount
+        existing_shares = conn.execute("SELECT shares FROM portfolios WHERE username = ? AND ticker = ?",
+                                       (order.username, order.ticker)).fetchone()
+
+        if not existing_shares or existing_shares[0] < order.amount:
+            raise OrderRejected("Insufficient shares to sell.")
+
+        new_shares = existing_shares[0] - order.amount
+        if new_shares == 0:
+            conn.execute("DELETE FROM portfolios WHERE username = ? AND ticker = ?", (order.username, order.ticker))
+        else:
+            conn.execute("UPDATE portfolios SET shares = ? WHERE username = ? AND ticker = ?",
+                         (new_shares, order.username, order.ticker))
+
+        user_currency = conn.execute("SELECT currency FROM users WHERE username = ?",
+                                     (order.username,)).fetchone()[0]
+        total_value_in_user_currency = total_value * fx_rate(order.fx_rates, user_currency)
+        conn.execute("UPDATE users SET balance = balance + ?, version = version + 1 WHERE username = ?",
+                     (total_value_in_user_currency, order.username))
+        conn.execute("INSERT INTO transactions (username, action, ticker, amount, price) VALUES (?, ?, ?, ?, ?)",
+                     (order.username, 'Sell', order.ticker, order.amount, order.price))
+        record_position_cost(conn, order.username, 'Sell', order.ticker, order.amount, order.price)
+        return f"Successfully sold {order.amount} shares of {order.ticker} for ${total_value_in_user_currency:.2f} {user_currency}"
+
+@process_resource
+def get_order_engine():
+    get_db_pool()
+    engine = OrderEngine()
+    engine.start()
+    return engine
+
+# Function to look up the USD conversion rate for a currency in a rate table
+def fx_rate(rates, currency):
+    if currency == 'USD':
+        return 1
+    return rates.get(currency, 1)
+
+# Function to price an order from the market snapshot and hand it to the
+# order engine; no database lock is held while pricing
+def place_order(username, action, ticker, amount):
+    ticker = ticker.upper()
+    quotes = get_latest_quotes([ticker])
+    if ticker not in quotes.index:
+        return "Invalid ticker symbol."
+    snapshot = get_market_snapshot()
+    fx_rates = snapshot.fx_rates if snapshot is not None else get_fx_table().get_rates('USD')
+    order = Order(username, action, ticker, amount, quotes.at[ticker, 'Close'], fx_rates)
+    return get_order_engine().submit(order)
+
+# Function to price a list of (action, ticker, amount) legs with one batched
+# quote fetch and one rate lookup, then execute them in a single transaction
+@instrumented('place_basket')
+def place_basket(username, legs):
+    legs = [(action, ticker.strip().upper(), int(amount)) for action, ticker, amount in legs
+            if ticker and ticker.strip() and amount and amount > 0]
+    if not legs:
+        return "No orders to execute."
+    quotes = get_latest_quotes([ticker for _, ticker, _ in legs])
+    unknown = sorted({ticker for _, ticker, _ in legs if ticker not in quotes.index})
+    if unknown:
+        return f"Invalid ticker symbol: {', '.join(unknown)}."
+    snapshot = get_market_snapshot()
+    fx_rates = snapshot.fx_rates if snapshot is not None else get_fx_table().get_rates('USD')
+    basket = Basket(username, 'Basket', [
+        Order(username, action, ticker, amount, quotes.at[ticker, 'Close'], fx_rates)
+        for action, ticker, amount in legs
+    ], fx_rates)
+    return get_order_engine().submit(basket)
+
 # Function to buy stock
+@instrumented('buy_stock')
 def buy_stock(username, ticker, amount, conn, currency):
-    current_price = get_stock_data(ticker, period='1d')
-    
-    if current_price is None or current_price.empty:
-        return "Invalid ticker symbol."
-    
-    total_cost = current_price['Close'].iloc[-1] * amount
-    
-    c = conn.cursor()
-    c.execute("SELECT balance, currency FROM users WHERE username = ?", (username,))
-    user_balance, user_currency = c.fetchone()
-    
-    total_cost_in_user_currency = convert_currency(total_cost, 'USD', user_currency)
-    
-    if user_balance < total_cost_in_user_currency:
-        return "Insufficient funds."
-    
-    new_balance = user_balance - total_cost_in_user_currency
-    c.execute("UPDATE users SET balance = ? WHERE username = ?", (new_balance, username))
-    
-    c.execute("SELECT shares FROM portfolios WHERE username = ? AND ticker = ?", (username, ticker))
-    existing_shares = c.fetchone()
-    
-    if existing_shares:
-        new_shares = existing_shares[0] + amount
-        c.execute("UPDATE portfolios SET shares = ?, initial_investment = initial_investment + ? WHERE username = ? AND ticker = ?", (new_shares, total_cost, username, ticker))
-    else:
-        c.execute("INSERT INTO portfolios (username, ticker, shares, initial_investment) VALUES (?, ?, ?, ?)", (username, ticker, amount, total_cost))
-    
-    c.execute("INSERT INTO transactions (username, action, ticker, amount, price) VALUES (?, ?, ?, ?, ?)", 
-              (username, 'Buy', ticker, amount, current_price['Close'].iloc[-1]))
-    
-    conn.commit()
-    return f"Successfully bought {amount} shares of {ticker} for ${total_cost_in_user_currency:.2f} {user_currency}"
+    return place_order(username, 'Buy', ticker, amount)
 
 # Function to sell stock
+@instrumented('sell_stock')
 def sell_stock(username, ticker, amount, conn, currency):
-    current_price = get_stock_data(ticker, period='1d')
-    
-    if current_price is None or current_price.empty:
-        return "Invalid ticker symbol."
-    
-    total_value = current_price['Close'].iloc[-1] * amount
-    
-    c = conn.cursor()
-    c.execute("SELECT shares FROM portfolios WHERE username = ? AND ticker = ?", (username, ticker))
-    existing_shares = c.fetchone()
-    
-    if not existing_shares or existing_shares[0] < amount:
-        return "Insufficient shares to sell."
-    
-    new_shares = existing_shares[0] - amount
-    if new_shares == 0:
-        c.execute("DELETE FROM portfolios WHERE username = ? AND ticker = ?", (username, ticker))
+    return place_order(username, 'Sell', ticker, amount)
+
+# Function to read one page of a player's trades, newest first. Pages are
+# keyed on the (timestamp, rowid) of the last row already shown rather than
+# an OFFSET, so each page is a short range scan of idx_transactions_user_time
+def get_transaction_page(conn, username, before=None, limit=TRANSACTION_PAGE_SIZE):
+    if before is None:
+        return pd.read_sql_query(
+            "SELECT rowid, timestamp, action, ticker, amount, price FROM transactions "
+            "WHERE username = ? ORDER BY timestamp DESC, rowid DESC LIMIT ?",
+            conn, params=(username, limit))
+    return pd.read_sql_query(
+        "SELECT rowid, timestamp, action, ticker, amount, price FROM transactions "
+        "WHERE username = ? AND (timestamp, rowid) < (?, ?) ORDER BY timestamp DESC, rowid DESC LIMIT ?",
+        conn, params=(username, before[0], before[1], limit))
+
+# Function to summarise a player's trades per ticker. Counts and volume are
+# aggregated in SQL; avg_cost and realized P&L (average cost method) come
+# from position_costs, which the order engine updates with every trade
+def get_trade_analytics(conn, username):
+    return pd.read_sql_query('''
+    SELECT t.ticker, t.trades, t.bought, t.sold, t.volume,
+           CASE WHEN p.shares > 0 THEN p.cost / p.shares END AS avg_cost,
+           COALESCE(p.realized_pnl, 0) AS realized_pnl
+    FROM (
+        SELECT ticker, COUNT(*) AS trades,
+               SUM(CASE WHEN action = 'Buy' THEN amount ELSE 0 END) AS bought,
+               SUM(CASE WHEN action = 'Buy' THEN 0 ELSE amount END) AS sold,
+               SUM(amount * price) AS volume
+        FROM transactions
+        WHERE username = ?
+        GROUP BY ticker
+    ) t
+    LEFT JOIN position_costs p ON p.username = ? AND p.ticker = t.ticker
+    ORDER BY t.volume DESC
+    ''', conn, params=(username, username))
+
+# Result of replaying trades: per-bar equity, cash and holdings value, and
+# the shares held in each ticker at each bar
+Replay = namedtuple('Replay', ['equity', 'holdings'])
+
+# Function to build a Close price matrix (dates x tickers) from the cached
+# daily history, forward-filled over bars a ticker is missing
+def get_price_matrix(tickers, period):
+    history = get_stock_data_batch(tickers, period)
+    if history.empty:
+        return pd.DataFrame()
+    dates = pd.to_datetime(history['Date'])
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    history = history.assign(Date=dates.dt.normalize())
+    return history.pivot_table(index='Date', columns='Ticker', values='Close', aggfunc='last').sort_index().ffill()
+
+# Function to replay one player's trades over a price matrix. Holdings and
+# cash are cumulative sums over the trade log, and each bar picks the state
+# after the last trade made before the bar's day ended. Trade prices are in
+# USD and converted into the player's currency with rate, as the order
+# engine does. With hold_sells the sells are skipped, answering "what if I
+# had held instead"
+def replay_trades(trades, prices, initial_balance, rate, hold_sells=False):
+    if hold_sells:
+        trades = trades[trades['action'] == 'Buy']
+    trades = trades.sort_values('timestamp', kind='stable')
+    tickers = prices.columns
+    if trades.empty:
+        holdings = np.zeros((len(prices), len(tickers)))
+        cash = np.full(len(prices), float(initial_balance))
+        return replay_result(prices, holdings, cash, rate)
+
+    sign = np.where(trades['action'].to_numpy() == 'Buy', 1.0, -1.0)
+    amount = trades['amount'].to_numpy(dtype=float)
+    column = tickers.get_indexer(trades['ticker'].str.upper())
+
+    delta = np.zeros((len(trades), len(tickers)))
+    priced = column >= 0
+    delta[np.flatnonzero(priced), column[priced]] = (sign * amount)[priced]
+    cum_holdings = np.cumsum(delta, axis=0)
+    cum_cash = initial_balance - np.cumsum(sign * amount * trades['price'].to_numpy(dtype=float)) * rate
+
+    trade_times = pd.to_datetime(trades['timestamp']).to_numpy()
+    bar_ends = (prices.index + pd.Timedelta(days=1)).to_numpy()
+    last_trade = np.searchsorted(trade_times, bar_ends, side='left') - 1
+    traded = last_trade >= 0
+    holdings = np.where(traded[:, None], cum_holdings[np.maximum(last_trade, 0)], 0.0)
+    cash = np.where(traded, cum_cash[np.maximum(last_trade, 0)], float(initial_balance))
+    return replay_result(prices, holdings, cash, rate)
+
+def replay_result(prices, holdings, cash, rate):
+    holdings_value = np.nansum(holdings * prices.to_numpy(), axis=1) * rate
+    equity = pd.DataFrame({'Cash': cash, 'Holdings Value': holdings_value, 'Equity': cash + holdings_value},
+                          index=prices.index)
+    return Replay(equity, pd.DataFrame(holdings, index=prices.index, columns=prices.columns))
+
+# Function to load trades for one player, or every player when username is None
+def load_trades(conn, username=None):
+    if username is None:
+        return pd.read_sql_query("SELECT username, timestamp, action, ticker, amount, price FROM transactions", conn)
+    return pd.read_sql_query(
+        "SELECT username, timestamp, action, ticker, amount, price FROM transactions WHERE username = ?",
+        conn, params=(username,))
+
+# Function to replay every player at once over one shared price matrix;
+# returns an equity matrix (dates x players), each in the player's currency.
+# The connection is only held for the reads, not while history downloads
+def replay_all_users(period, hold_sells=False):
+    with get_db_pool().connection() as conn:
+        trades = load_trades(conn)
+        users = conn.execute("SELECT username, initial_balance, currency FROM users").fetchall()
+    prices = get_price_matrix(trades['ticker'].str.upper().unique(), period)
+    if prices.empty:
+        return pd.DataFrame()
+    snapshot = get_market_snapshot()
+    fx_rates = snapshot.fx_rates if snapshot is not None else get_fx_table().get_rates('USD')
+    accounts = {username: (initial_balance, currency) for username, initial_balance, currency in users}
+    equity = {}
+    for username, user_trades in trades.groupby('username', sort=False):
+        initial_balance, currency = accounts.get(username, (INITIAL_BALANCE, 'USD'))
+        equity[username] = replay_trades(user_trades, prices, initial_balance, fx_rate(fx_rates, currency),
+                                         hold_sells).equity['Equity']
+    return pd.DataFrame(equity, index=prices.index)
+
+# Function to fetch the latest articles for a query from NewsAPI
+def fetch_news(api_key, query, language='en', page_size=5):
+    return get_single_flight().do(('news', api_key, query, language, page_size),
+                                  lambda: get_data_provider().news(api_key, query, language, page_size))
+
+# News fetched on worker threads into a TTL cache keyed by
+# (query, language, page_size). Renders only read the cache; a miss queues
+# a fetch and the panel picks the result up on its next poll. Failures are
+# cached per API key, so one player's bad key never hides news from others
+class NewsService:
+    def __init__(self):
+        self.cache = QuoteCache(max_size=NEWS_CACHE_SIZE)
+        self.errors = QuoteCache(max_size=NEWS_CACHE_SIZE)
+        self.executor = ThreadPoolExecutor(max_workers=NEWS_WORKERS, thread_name_prefix='news')
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    # Returns ('ok', articles) or ('error', message), or None while fetching
+    def get(self, api_key, query, language='en', page_size=5):
+        key = (query, language, page_size)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.errors.get((api_key,) + key)
+        if result is None:
+            self.request(api_key, key)
+        return result
+
+    def request(self, api_key, key):
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        self.executor.submit(self.fetch, api_key, key)
+
+    def fetch(self, api_key, key):
+        query, language, page_size = key
+        try:
+            articles = fetch_news(api_key, query, language, page_size)
+            self.cache.put(key, ('ok', articles), NEWS_CACHE_TTL)
+        except Exception as e:
+            self.errors.put((api_key,) + key, ('error', str(e)), NEWS_ERROR_TTL)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def prefetch(self, api_key, queries, language='en', page_size=5):
+        for query in queries:
+            key = (query, language, page_size)
+            if not self.cache.peek(key) and not self.errors.peek((api_key,) + key):
+                self.request(api_key, key)
+
+@process_resource
+def get_news_service():
+    return NewsService()
+
+# Function to pick the NewsAPI key for a session, if one is available;
+# providers that need no key get the placeholder
+def get_news_api_key():
+    api_key = st.session_state.get('news_api_key') or NEWS_API_KEY
+    if api_key != 'your_newsapi_key_here' or not get_data_provider().news_requires_key:
+        return api_key
+    return None
+
+# Function to warm the news cache for every ticker a player holds
+def prefetch_holdings_news(username, conn):
+    api_key = get_news_api_key()
+    state = get_portfolio_state(username, conn)
+    if api_key and state is not None:
+        held = [ticker for ticker, shares in zip(state.tickers, state.shares) if shares > 0]
+        get_news_service().prefetch(api_key, held)
+
+# Dashboard panels. Each one is a Streamlit fragment, so using a panel's
+# widgets reruns only that panel. Panels that read the database borrow their
+# own connection because a fragment can rerun after main() has returned
+@st.fragment(run_every=UPDATE_INTERVAL)
+@timed_panel('overview')
+def overview_panel(username):
+    with get_db_pool().connection() as conn:
+        display_financial_overview(username, conn)
+
+@st.fragment
+@timed_panel('equity_curve')
+def equity_curve_panel(username):
+    with get_db_pool().connection() as conn:
+        display_equity_curve(username, conn)
+
+@st.fragment
+@timed_panel('holdings')
+def holdings_panel(username):
+    st.markdown('<div class="sub-title">Personal Holdings and Stocks</div>', unsafe_allow_html=True)
+    time_range = st.selectbox("Select Time Range for Holdings", list(TIME_RANGES.keys()))
+    with get_db_pool().connection() as conn:
+        _, _, _, portfolio = get_user_data(username, conn)
+    if portfolio:
+        plot_holdings(portfolio, time_range)
+    else:
+        st.write("No stocks in your portfolio.")
+
+@st.fragment
+@timed_panel('trade')
+def trade_panel(username):
+    st.markdown('<div class="sub-title">Buy/Sell Stocks</div>', unsafe_allow_html=True)
+    action = st.selectbox("Choose Action", ["Buy", "Sell"])
+    ticker = st.text_input("Ticker")
+    amount = st.number_input("Amount", min_value=1, step=1)
+    selected_currency = st.selectbox("Currency", CURRENCIES)
+
+    if st.button(f"{action} Stocks"):
+        if action == "Buy":
+            result = buy_stock(username, ticker, amount, None, selected_currency)
+        else:
+            result = sell_stock(username, ticker, amount, None, selected_currency)
+        if result.startswith("Successfully"):
+            # Balances and holdings changed, so every panel has to redraw
+            st.session_state.trade_result = result
+            st.rerun()
+        st.write(result)
+    elif 'trade_result' in st.session_state:
+        st.write(st.session_state.pop('trade_result'))
+
+@st.fragment
+@timed_panel('basket')
+def basket_panel(username):
+    st.markdown('<div class="sub-title">Basket Orders</div>', unsafe_allow_html=True)
+    orders = st.data_editor(
+        pd.DataFrame({'Action': pd.Series(dtype=str), 'Ticker': pd.Series(dtype=str), 'Amount': pd.Series(dtype=int)}),
+        num_rows="dynamic",
+        column_config={
+            'Action': st.column_config.SelectboxColumn("Action", options=["Buy", "Sell"], default="Buy", required=True),
+            'Ticker': st.column_config.TextColumn("Ticker", required=True),
+            'Amount': st.column_config.NumberColumn("Amount", min_value=1, step=1, default=1, required=True)
+        },
+        use_container_width=True,
+        key="basket_orders"
+    )
+
+    if st.button("Execute Basket"):
+        legs = orders.dropna(subset=['Ticker', 'Amount'])
+        result = place_basket(username, zip(legs['Action'].fillna("Buy"), legs['Ticker'], legs['Amount']))
+        if result.startswith("Successfully"):
+            st.session_state.trade_result = result
+            st.rerun()
+        st.write(result)
+
+@st.fragment(run_every=UPDATE_INTERVAL)
+@timed_panel('market')
+def market_panel():
+    market_status = get_market_status()
+    market_overview_ticker(market_status)
+
+@st.fragment(run_every=UPDATE_INTERVAL)
+@timed_panel('currency_and_gold')
+def currency_and_gold_panel():
+    display_currency_and_gold()
+
+@st.fragment
+@timed_panel('lookup')
+def lookup_panel():
+    import plotly.graph_objects as go
+    st.markdown('<div class="sub-title">Stock Lookup</div>', unsafe_allow_html=True)
+    stock_ticker = st.text_input("Enter Stock Ticker for Lookup")
+    time_range_lookup = st.selectbox("Select Time Range", list(TIME_RANGES.keys()), key="lookup")
+    if st.button("Lookup"):
+        df = get_stock_data(stock_ticker, period=TIME_RANGES[time_range_lookup])
+        if df is not None and not df.empty:
+            fig = go.Figure(price_trace(df, stock_ticker))
+            fig.update_layout(title=f"{stock_ticker} - {time_range_lookup}",
+                              xaxis_title='Date', yaxis_title='Close')
+            st.plotly_chart(fig, use_container_width=True)
+        else:
+            st.write("No data available for this ticker.")
+
+@st.fragment
+@timed_panel('news')
+def news_panel(username):
+    st.markdown('<div class="sub-title">Stock Market News</div>', unsafe_allow_html=True)
+    news_ticker = st.text_input("Enter Stock Ticker for News")
+    news_api_key = st.text_input("Enter NewsAPI Key")
+    if news_api_key and news_api_key != st.session_state.get('news_api_key'):
+        st.session_state.news_api_key = news_api_key
+        st.session_state.news_prefetched = False
+    if not st.session_state.get('news_prefetched') and get_news_api_key():
+        with get_db_pool().connection() as conn:
+            prefetch_holdings_news(username, conn)
+        st.session_state.news_prefetched = True
+    if st.button("Get News"):
+        st.session_state.news_query = news_ticker
+
+    query = st.session_state.get('news_query')
+    if query is None:
+        return
+    api_key = get_news_api_key()
+    if not api_key:
+        st.write("Please enter a valid NewsAPI key.")
+        return
+    result = get_news_service().get(api_key, query)
+    if result is None:
+        news_poller(api_key, query)
+    elif result[0] == 'error':
+        st.error(f"Failed to fetch news: {result[1]}")
+    elif result[1] and result[1]['articles']:
+        for article in result[1]['articles']:
+            st.subheader(article['title'])
+            st.write(article['description'])
+            st.write(f"[Read more]({article['url']})")
+    else:
+        st.write("No news available for this ticker.")
+
+# Rendered by the news panel only while its fetch is in flight, so the
+# polling stops as soon as the articles have been shown
+@st.fragment(run_every=NEWS_POLL_INTERVAL)
+def news_poller(api_key, query):
+    st.write("Fetching news...")
+    if get_news_service().get(api_key, query) is not None:
+        st.rerun()
+
+# Function to display the trading dashboard
+def display_dashboard(username):
+    overview_panel(username)
+    equity_curve_panel(username)
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        holdings_panel(username)
+        trade_panel(username)
+        basket_panel(username)
+
+    with col2:
+        market_panel()
+        currency_and_gold_panel()
+
+    lookup_panel()
+    news_panel(username)
+
+@st.fragment
+@timed_panel('transaction_history')
+def transaction_history_panel(username):
+    st.markdown('<div class="sub-title">Transaction History</div>', unsafe_allow_html=True)
+    # Stack of page cursors; the last one is the page being shown
+    cursors = st.session_state.setdefault('history_cursors', [None])
+    with get_db_pool().connection() as conn:
+        page = get_transaction_page(conn, username, before=cursors[-1])
+    if page.empty:
+        st.write("No transactions yet.")
+    else:
+        st.dataframe(page.drop(columns='rowid').rename(columns=str.title), use_container_width=True, hide_index=True)
+
+    newer, older = st.columns(2)
+    if newer.button("Newer", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun(scope="fragment")
+    if older.button("Older", disabled=len(page) < TRANSACTION_PAGE_SIZE):
+        last = page.iloc[-1]
+        cursors.append((last['timestamp'], int(last['rowid'])))
+        st.rerun(scope="fragment")
+
+@st.fragment
+@timed_panel('replay')
+def replay_panel(username):
+    import plotly.graph_objects as go
+    st.markdown('<div class="sub-title">Replay</div>', unsafe_allow_html=True)
+    time_range = st.selectbox("Select Time Range for Replay", list(TIME_RANGES.keys()), index=5, key="replay_range")
+    what_if = st.checkbox("Compare with holding instead of selling")
+    with get_db_pool().connection() as conn:
+        trades = load_trades(conn, username)
+        state = get_portfolio_state(username, conn)
+    if trades.empty:
+        st.write("No trades to replay.")
+        return
+    prices = get_price_matrix(trades['ticker'].str.upper().unique(), TIME_RANGES[time_range])
+    if prices.empty:
+        st.write("No price history available for your trades.")
+        return
+
+    snapshot = get_market_snapshot()
+    fx_rates = snapshot.fx_rates if snapshot is not None else get_fx_table().get_rates('USD')
+    rate = fx_rate(fx_rates, state.currency)
+    fig = go.Figure(layout_title_text=f"Replayed Equity ({state.currency}) - {time_range}")
+    actual = replay_trades(trades, prices, state.initial_balance, rate).equity
+    fig.add_trace(price_trace(actual.reset_index().rename(columns={'Equity': 'Close'}), "Actual"))
+    if what_if:
+        held = replay_trades(trades, prices, state.initial_balance, rate, hold_sells=True).equity
+        fig.add_trace(price_trace(held.reset_index().rename(columns={'Equity': 'Close'}), "Held instead of selling"))
+    st.plotly_chart(fig, use_container_width=True)
+
+# Function to display a player's trade history and per-ticker analytics
+def display_history(username):
+    st.markdown('<div class="sub-title">Trade Analytics</div>', unsafe_allow_html=True)
+    with get_db_pool().connection() as conn:
+        analytics = get_trade_analytics(conn, username)
+    if analytics.empty:
+        st.write("No trades yet.")
     else:
-        c.execute("UPDATE portfolios SET shares = ? WHERE username = ? AND ticker = ?", (new_shares, username, ticker))
-    
-    c.execute("SELECT balance, currency FROM users WHERE username = ?", (username,))
-    user_balance, user_currency = c.fetchone()
-    total_value_in_user_currency = convert_currency(total_value, 'USD', user_currency)
-    new_balance = user_balance + total_value_in_user_currency
-    c.execute("UPDATE users SET balance = ? WHERE username = ?", (new_balance, username))
-    
-    c.execute("INSERT INTO transactions (username, action, ticker, amount, price) VALUES (?, ?, ?, ?, ?)", 
-              (username, 'Sell', ticker, amount, current_price['Close'].iloc[-1]))
-    
-    conn.commit()
-    return f"Successfully sold {amount} shares of {ticker} for ${total_value_in_user_currency:.2f} {user_currency}"
+        st.markdown(f'<div class="metric-box">Realized P&L: ${analytics["realized_pnl"].sum():.2f}</div>', unsafe_allow_html=True)
+        st.dataframe(
+            analytics.rename(columns={
+                'ticker': 'Ticker',
+                'trades': 'Trades',
+                'bought': 'Shares Bought',
+                'sold': 'Shares Sold',
+                'volume': 'Volume ($)',
+                'avg_cost': 'Average Cost ($)',
+                'realized_pnl': 'Realized P&L ($)'
+            }),
+            use_container_width=True,
+            hide_index=True
+        )
+    replay_panel(username)
+    transaction_history_panel(username)
+
+# Function to display the leaderboard of every player ranked by return
+def display_leaderboard(username):
+    st.markdown('<div class="sub-title">Leaderboard</div>', unsafe_allow_html=True)
+    with get_db_pool().connection() as conn:
+        users, holdings = load_all_holdings(conn)
+    valuations = value_all_users(users, holdings)
+    if valuations.empty:
+        st.write("No players yet.")
+        return
+    board = valuations.reset_index(drop=True)
+    board.index = board.index + 1
+    st.dataframe(
+        board[['username', 'total_value', 'invested_value', 'return_pct', 'currency']].rename(columns={
+            'username': 'Player',
+            'total_value': 'Total Value',
+            'invested_value': 'Invested Value',
+            'return_pct': 'Return (%)',
+            'currency': 'Currency'
+        }).style.format({'Total Value': '{:.2f}', 'Invested Value': '{:.2f}', 'Return (%)': '{:.2f}'}),
+        use_container_width=True
+    )
+    rank = board.index[board['username'] == username]
+    if len(rank):
+        st.markdown(f'<div class="metric-box">Your rank: {rank[0]} of {len(board)}</div>', unsafe_allow_html=True)
+
+# Function to display latency, error and cache metrics to admins
+def display_diagnostics():
+    st.markdown('<div class="sub-title">Diagnostics</div>', unsafe_allow_html=True)
+    metrics = get_metrics()
+    summary = metrics.summary()
+    if summary.empty:
+        st.write("No metrics recorded yet.")
+    else:
+        st.dataframe(summary.sort_values('p99 (ms)', ascending=False).style.format(
+            {'Mean (ms)': '{:.2f}', 'p50 (ms)': '{:.2f}', 'p99 (ms)': '{:.2f}', 'Max (ms)': '{:.2f}'}),
+            use_container_width=True, hide_index=True)
+
+    st.markdown('<div class="sub-title">Caches</div>', unsafe_allow_html=True)
+    gauges = metrics.gauges()
+    st.dataframe(pd.DataFrame(
+        [{'Gauge': name.replace('charging_bull_', ''), 'Label': labels[0][1], 'Value': value}
+         for name, labels, value in gauges]), use_container_width=True, hide_index=True)
+
+    with st.expander("Prometheus export"):
+        st.code(metrics.render(), language='text')
+
+# Function to check a player's username and password
+@instrumented('authenticate')
+def authenticate(username, password, conn):
+    c = conn.cursor()
+    c.execute("SELECT * FROM users WHERE username=? AND password=?", (username, hash_password(password)))
+    return c.fetchone() is not None
+
+# Function to open a new account; False if the username is already taken
+@instrumented('create_account')
+def create_account(username, password, conn):
+    c = conn.cursor()
+    try:
+        c.execute("INSERT INTO users (username, password, balance, initial_balance, currency) VALUES (?, ?, ?, ?, ?)",
+                  (username, hash_password(password), INITIAL_BALANCE, INITIAL_BALANCE, DEFAULT_CURRENCY))
+        for ticker in STOCK_LIST:
+            c.execute("INSERT INTO portfolios (username, ticker, shares, initial_investment) VALUES (?, ?, 0, 0)", (username, ticker))
+        conn.commit()
+        return True
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        return False
 
 # Main function with enhanced layout and features
 def main():
-    ensure_database_schema()
+    pool = get_db_pool()
     initialize_music()
+    start_market_refresher()
+    start_valuation_scheduler()
+    start_metrics_exporter()
 
     if 'logged_in' not in st.session_state:
         st.session_state.logged_in = False
@@ -417,96 +2405,45 @@ def main():
         username_input = st.text_input("Username")
         password_input = st.text_input("Password", type="password")
         if st.button("Login"):
-            conn = setup_database()
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE username=? AND password=?", (username_input, hash_password(password_input)))
-            if c.fetchone():
+            with pool.connection() as conn:
+                authenticated = authenticate(username_input, password_input, conn)
+            if authenticated:
                 st.session_state.logged_in = True
                 st.session_state.username = username_input
             else:
                 st.error("Invalid username or password")
 
         if st.button("Create Account"):
-            conn = setup_database()
-            c = conn.cursor()
-            try:
-                c.execute("INSERT INTO users (username, password, balance, initial_balance, currency) VALUES (?, ?, ?, ?, ?)",
-                          (username_input, hash_password(password_input), INITIAL_BALANCE, INITIAL_BALANCE, DEFAULT_CURRENCY))
-                for ticker in STOCK_LIST:
-                    c.execute("INSERT INTO portfolios (username, ticker, shares, initial_investment) VALUES (?, ?, 0, 0)", (username_input, ticker))
-                conn.commit()
+            with pool.connection() as conn:
+                created = create_account(username_input, password_input, conn)
+            if created:
                 st.success("Account created successfully!")
-            except sqlite3.IntegrityError:
+            else:
                 st.error("Username already exists.")
     else:
         username = st.session_state.username
-        conn = setup_database()
         st.sidebar.write(f"Welcome, {username}!")
         if st.sidebar.button("Logout"):
             st.session_state.logged_in = False
             st.session_state.username = None
 
         # Add the small Charging Bull image under the Logout button
-        st.sidebar.image("trade.png", width=150)
-
-        display_financial_overview(username, conn)
+        st.sidebar.image(load_image("trade.png"), width=150)
+        pages = PAGES + ["Diagnostics"] if username in ADMIN_USERS else PAGES
+        page = st.sidebar.radio("Page", pages)
 
-        col1, col2 = st.columns(2)
-
-        with col1:
-            st.markdown('<div class="sub-title">Personal Holdings and Stocks</div>', unsafe_allow_html=True)
-            time_range = st.selectbox("Select Time Range for Holdings", list(TIME_RANGES.keys()))
-            _, _, _, portfolio = get_user_data(username, conn)
-            if portfolio:
-                plot_holdings(portfolio, time_range)
-            else:
-                st.write("No stocks in your portfolio.")
-
-            st.markdown('<div class="sub-title">Buy/Sell Stocks</div>', unsafe_allow_html=True)
-            action = st.selectbox("Choose Action", ["Buy", "Sell"])
-            ticker = st.text_input("Ticker")
-            amount = st.number_input("Amount", min_value=1, step=1)
-            selected_currency = st.selectbox("Currency", CURRENCIES)
-            
-            if st.button(f"{action} Stocks"):
-                if action == "Buy":
-                    result = buy_stock(username, ticker, amount, conn, selected_currency)
-                else:
-                    result = sell_stock(username, ticker, amount, conn, selected_currency)
-                st.write(result)
-
-        with col2:
-            market_status = get_market_status()
-            market_overview_ticker(market_status)
-            display_currency_and_gold()
-
-        st.markdown('<div class="sub-title">Stock Lookup</div>', unsafe_allow_html=True)
-        stock_ticker = st.text_input("Enter Stock Ticker for Lookup")
-        time_range_lookup = st.selectbox("Select Time Range", list(TIME_RANGES.keys()), key="lookup")
-        if st.button("Lookup"):
-            df = get_stock_data(stock_ticker, period=TIME_RANGES[time_range_lookup])
-            if df is not None and not df.empty:
-                fig = px.line(df, x='Date', y='Close', title=f"{stock_ticker} - {time_range_lookup}")
-                st.plotly_chart(fig, use_container_width=True)
-            else:
-                st.write("No data available for this ticker.")
-
-        st.markdown('<div class="sub-title">Stock Market News</div>', unsafe_allow_html=True)
-        news_ticker = st.text_input("Enter Stock Ticker for News")
-        news_api_key = st.text_input("Enter NewsAPI Key")
-        if st.button("Get News"):
-            if news_api_key:
-                newsapi = NewsApiClient(api_key=news_api_key)
-                articles = newsapi.get_everything(q=news_ticker, language='en', sort_by='publishedAt', page_size=5)
-                if articles:
-                    for article in articles['articles']:
-                        st.subheader(article['title'])
-                        st.write(article['description'])
-                        st.write(f"[Read more]({article['url']})")
-                else:
-                    st.write("No news available for this ticker.")
-            else:
-                st.write("Please enter a valid NewsAPI key.")
+        # Pages only hold a connection while they query; the fragments
+        # they render borrow their own, so none is held across a render
+        if page == "Diagnostics":
+            display_diagnostics()
+        elif page == "Leaderboard":
+            display_leaderboard(username)
+        elif page == "History":
+            display_history(username)
+        else:
+            display_dashboard(username)
 
 if __name__ == "__main__":
-    main()
+    timed_panel('rerun')(main)()
+    record_startup_timing('import', IMPORT_SECONDS)
+    record_startup_timing('first_paint', time.perf_counter() - SCRIPT_STARTED)
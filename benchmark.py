@@ -0,0 +1,229 @@
+# Load test for Charging Bull Trader. Simulates concurrent players who log
+# in, load the dashboard, trade and value their portfolios, while a
+# background thread logs everyone's valuations the way the leaderboard
+# scheduler does. Once they finish, every player's trades are replayed in
+# one batch over ten years of bars. Market data comes from the deterministic replay provider,
+# so runs need no network and are comparable between commits. No fixtures
+# ship with the repo, so unless some have been recorded with --record the
+# replay provider serves its seeded random walks.
+#
+#   python benchmark.py --users 50 --sessions 20
+#   python benchmark.py --json results.json
+#   python benchmark.py --record        # save live market data as fixtures
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+OPERATIONS = ['login', 'dashboard', 'trade', 'value', 'leaderboard', 'replay']
+PERCENTILES = (50, 99)
+
+# Per-operation latencies and error counts gathered from every player thread
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.errors = {operation: 0 for operation in OPERATIONS}
+        self.locked = 0
+
+    def time(self, operation, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        except Exception as e:
+            with self.lock:
+                self.errors[operation] += 1
+                if 'locked' in str(e):
+                    self.locked += 1
+            print(f"Error in {operation}: {str(e)}")
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.latencies[operation].append(elapsed)
+
+# Function to read what the dashboard panels read for one player
+def render_dashboard(app, username, rng):
+    with app.get_db_pool().connection() as conn:
+        app.calculate_total_value(username, conn)
+        app.get_equity_curve(username, conn)
+        _, _, _, portfolio = app.get_user_data(username, conn)
+    held = [ticker for ticker, data in portfolio.items() if data['shares'] > 0]
+    if held:
+        app.get_stock_data_batch(held, period=rng.choice(['1d', '5d', '1mo', '1y']))
+    app.get_market_status()
+    app.get_currency_values()
+    app.get_gold_price()
+    app.get_news_service().get(app.NEWS_API_KEY, rng.choice(app.STOCK_LIST))
+
+# Function to place one random order, selling only what the player holds
+def trade(app, username, rng):
+    with app.get_db_pool().connection() as conn:
+        _, _, _, portfolio = app.get_user_data(username, conn)
+    held = [ticker for ticker, data in portfolio.items() if data['shares'] > 0]
+    if held and rng.random() < 0.4:
+        ticker = rng.choice(held)
+        return app.sell_stock(username, ticker, rng.randint(1, int(portfolio[ticker]['shares'])), None, 'USD')
+    return app.buy_stock(username, rng.choice(app.STOCK_LIST), rng.randint(1, 5), None, 'USD')
+
+def value(app, username):
+    with app.get_db_pool().connection() as conn:
+        return app.calculate_total_value(username, conn)
+
+def leaderboard(app):
+    with app.get_db_pool().connection() as conn:
+        return app.log_valuations(conn)
+
+def login(app, username, password):
+    with app.get_db_pool().connection() as conn:
+        if not app.authenticate(username, password, conn):
+            raise ValueError(f"login failed for {username}")
+
+# Function to run one player's sessions: log in, then load the dashboard,
+# trade and check the portfolio value, with a short think time in between
+def run_player(app, recorder, username, sessions, think_time, seed):
+    rng = random.Random(seed)
+    for _ in range(sessions):
+        recorder.time('login', login, app, username, 'benchmark')
+        recorder.time('dashboard', render_dashboard, app, username, rng)
+        recorder.time('trade', trade, app, username, rng)
+        recorder.time('value', value, app, username)
+        if think_time:
+            time.sleep(rng.uniform(0, 2 * think_time))
+
+def run_valuations(app, recorder, interval, stop):
+    while True:
+        recorder.time('leaderboard', leaderboard, app)
+        if stop.wait(interval):
+            break
+
+# Function to summarise a metrics histogram as (count, p50 ms, p99 ms)
+def histogram_summary(histogram):
+    if histogram is None:
+        return 0, 0.0, 0.0
+    return histogram.count, histogram.quantile(0.5) * 1000, histogram.quantile(0.99) * 1000
+
+def run_benchmark(app, users, sessions, think_time, valuation_interval, seed):
+    recorder = Recorder()
+    usernames = [f"bench_{number:04d}" for number in range(users)]
+    with app.get_db_pool().connection() as conn:
+        for username in usernames:
+            app.create_account(username, 'benchmark', conn)
+    # Warm the history store and the market snapshot, as a running server would be
+    app.start_market_refresher()
+    app.get_latest_quotes(app.STOCK_LIST + [app.GOLD_TICKER])
+
+    stop = threading.Event()
+    valuer = threading.Thread(target=run_valuations, args=(app, recorder, valuation_interval, stop), daemon=True)
+    started = time.perf_counter()
+    valuer.start()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        for number, username in enumerate(usernames):
+            executor.submit(run_player, app, recorder, username, sessions, think_time, seed + number)
+    stop.set()
+    valuer.join()
+    wall_time = time.perf_counter() - started
+    recorder.time('replay', app.replay_all_users, '10y')
+
+    operations = {}
+    for operation in OPERATIONS:
+        latencies = np.array(recorder.latencies[operation]) * 1000
+        operations[operation] = {
+            'count': len(latencies),
+            'errors': recorder.errors[operation],
+            **{f"p{p}_ms": float(np.percentile(latencies, p)) if len(latencies) else 0.0 for p in PERCENTILES},
+            'max_ms': float(latencies.max()) if len(latencies) else 0.0
+        }
+
+    metrics = app.get_metrics()
+    with metrics.lock:
+        histograms = dict(metrics.histograms)
+    begin_count, begin_p50, begin_p99 = histogram_summary(
+        histograms.get(('charging_bull_query_seconds', (('name', 'BEGIN IMMEDIATE'),))))
+    batch_count, _, batch_p99 = histogram_summary(
+        histograms.get(('charging_bull_call_seconds', (('name', 'order_engine.batch'),))))
+    trades = operations['trade']['count']
+    return {
+        'users': users,
+        'sessions': users * sessions,
+        'wall_seconds': wall_time,
+        'sessions_per_second': users * sessions / wall_time,
+        'operations_per_second': sum(op['count'] for op in operations.values()) / wall_time,
+        'operations': operations,
+        'lock_contention': {
+            'write_transactions': begin_count,
+            'begin_immediate_p50_ms': begin_p50,
+            'begin_immediate_p99_ms': begin_p99,
+            'order_batches': batch_count,
+            'orders_per_batch': trades / batch_count if batch_count else 0.0,
+            'order_batch_p99_ms': batch_p99,
+            'database_locked_errors': recorder.locked
+        },
+        'caches': {f"{labels[0][1]}_{name.replace('charging_bull_cache_', '')}": value
+                   for name, labels, value in metrics.gauges() if name.startswith('charging_bull_cache_')}
+    }
+
+def print_report(results, provider):
+    print(f"\n{results['users']} players, {results['sessions']} sessions against the {provider} provider")
+    print(f"Wall time {results['wall_seconds']:.2f}s: {results['sessions_per_second']:.1f} sessions/s, "
+          f"{results['operations_per_second']:.1f} operations/s\n")
+    print(f"{'Operation':<12} {'Count':>7} {'Errors':>7} {'p50 ms':>9} {'p99 ms':>9} {'Max ms':>9}")
+    for operation, row in results['operations'].items():
+        print(f"{operation:<12} {row['count']:>7} {row['errors']:>7} {row['p50_ms']:>9.2f} "
+              f"{row['p99_ms']:>9.2f} {row['max_ms']:>9.2f}")
+    contention = results['lock_contention']
+    print("\nSQLite lock contention")
+    print(f"  BEGIN IMMEDIATE waits: {contention['write_transactions']} transactions, "
+          f"p50 {contention['begin_immediate_p50_ms']:.2f} ms, p99 {contention['begin_immediate_p99_ms']:.2f} ms")
+    print(f"  Order batches: {contention['order_batches']}, {contention['orders_per_batch']:.1f} orders each, "
+          f"p99 {contention['order_batch_p99_ms']:.2f} ms")
+    print(f"  'database is locked' errors: {contention['database_locked_errors']}")
+    print("\nCaches")
+    for name, value in sorted(results['caches'].items()):
+        print(f"  {name}: {value:.3f}" if isinstance(value, float) else f"  {name}: {value}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test Charging Bull Trader with simulated players.")
+    parser.add_argument('--users', type=int, default=50, help="concurrent players")
+    parser.add_argument('--sessions', type=int, default=20, help="sessions per player")
+    parser.add_argument('--think-time', type=float, default=0.0, help="mean pause between sessions, in seconds")
+    parser.add_argument('--valuation-interval', type=float, default=1.0,
+                        help="seconds between leaderboard valuation passes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--provider', default='replay', help="market data provider: replay or live")
+    parser.add_argument('--fixtures', default='fixtures', help="directory of recorded market data")
+    parser.add_argument('--database', help="SQLite file to use (default: a fresh temporary database)")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--record', action='store_true',
+                        help="record live market data into --fixtures and exit")
+    args = parser.parse_args()
+
+    # The app reads these when it is imported
+    os.environ['CHARGING_BULL_DATA_PROVIDER'] = args.provider
+    os.environ['CHARGING_BULL_FIXTURES'] = os.path.abspath(args.fixtures)
+    os.environ['CHARGING_BULL_DATABASE'] = args.database or os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    # Streamlit warns about the missing script run context on every call
+    # made outside `streamlit run`
+    logging.disable(logging.WARNING)
+    import app
+
+    if args.record:
+        app.record_fixtures(args.fixtures, app.STOCK_LIST + [app.GOLD_TICKER], app.CURRENCIES,
+                            app.STOCK_LIST, os.environ.get('NEWSAPI_KEY'))
+        print(f"Recorded fixtures in {args.fixtures}")
+        return
+
+    results = run_benchmark(app, args.users, args.sessions, args.think_time, args.valuation_interval, args.seed)
+    print_report(results, args.provider)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import threading
+
+# Streamlit re-executes app.py on every rerun, so its globals do not outlive
+# a single run, and st.cache_resource only returns cached values on a script
+# thread. Services shared with background threads live here instead: this
+# module is imported once per process.
+_lock = threading.RLock()
+_instances = {}
+
+# Decorator memoising a zero-argument factory for the life of the process
+def process_resource(factory):
+    key = factory.__qualname__
+
+    def get_instance():
+        instance = _instances.get(key)
+        if instance is None:
+            with _lock:
+                instance = _instances.get(key)
+                if instance is None:
+                    instance = factory()
+                    _instances[key] = instance
+        return instance
+
+    get_instance.__name__ = factory.__name__
+    get_instance.__qualname__ = key
+    return get_instance